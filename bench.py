@@ -0,0 +1,404 @@
+"""Нагрузочный тест бота против локальной заглушки Bot API (без сети).
+
+Запуск: python bench.py [--scenario orders status upload load] [--products 10000] [--json]
+
+Сценарии:
+  orders — массовые нажатия «Заказать» от множества покупателей;
+  status — одновременная смена статусов заказов несколькими админами;
+  upload — /upload_json с каталогом на --products товаров (новый и повторный без изменений);
+  load   — чтение products.json при старте (ProductCatalog.load).
+
+Обновления идут через тот же вебхук, что и в продакшене; задержка обновления считается
+от POST на вебхук до завершения всех хендлеров. Лимиты Telegram по умолчанию сняты,
+чтобы измерять накладные расходы самого бота (--telegram-limits их возвращает).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import logging
+import tempfile
+import shutil
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+BENCH_TOKEN = "123456:bench"
+CHANNEL_CHAT_ID = -1001000000000
+ADMIN_BASE_ID = 1000
+BUYER_BASE_ID = 100000
+SCENARIOS = ["orders", "status", "upload", "load"]
+# Методы Bot API, которые возвращают Message
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument",
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+}
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает на запросы как Telegram, считает вызовы по методам и добавляет задержку."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.files = {}
+        self.webhook_url = ""
+        self.texts = []
+        self._message_ids = iter(range(1, sys.maxsize))
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    async def wait_for_text(self, start, fragment, timeout):
+        """Ждёт сообщения с fragment среди отправленных после позиции start."""
+        deadline = time.monotonic() + timeout
+        while not any(fragment in text for text in self.texts[start:]):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"нет сообщения «{fragment}»")
+            await asyncio.sleep(0.01)
+
+    def _chat(self, params):
+        chat_id = params.get("chat_id", "")
+        try:
+            return {"id": int(chat_id), "type": "private", "first_name": "bench"}
+        except ValueError:
+            return {"id": CHANNEL_CHAT_ID, "type": "channel", "title": chat_id}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            return True
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]), "file_path": f"documents/{file_id}"}
+        if method in MESSAGE_METHODS:
+            self.texts.append(params.get("text") or params.get("caption") or "")
+            message_id = params.get("message_id")
+            return {
+                "message_id": int(message_id) if message_id else next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self._chat(params),
+                "text": params.get("text") or params.get("caption") or "",
+            }
+        return True
+
+    async def method(self, request: Request):
+        method = request.path_params["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = {}
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return JSONResponse({"ok": True, "result": self._result(method, params)})
+
+    async def file(self, request: Request):
+        self.calls["file"] = self.calls.get("file", 0) + 1
+        file_id = request.path_params["path"].rsplit("/", 1)[-1]
+        return Response(self.files[file_id], media_type="application/octet-stream")
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/bot{token}/{method}", self.method, methods=["POST"]),
+            Route("/file/bot{token}/{path:path}", self.file, methods=["GET"]),
+        ])
+
+class LatencyTracker:
+    """Время от отправки обновления на вебхук до завершения его обработки."""
+
+    def __init__(self):
+        self._started = {}
+        self.latencies = []
+        self._expected = 0
+        self._done = asyncio.Event()
+
+    def expect(self, count):
+        self.latencies = []
+        self._expected = count
+        self._done.clear()
+
+    def sent(self, update_id):
+        self._started[update_id] = time.perf_counter()
+
+    async def finished(self, update, context):
+        started = self._started.pop(update.update_id, None)
+        if started is None:
+            return
+        self.latencies.append(time.perf_counter() - started)
+        if len(self.latencies) >= self._expected:
+            self._done.set()
+
+    async def wait(self, timeout):
+        await asyncio.wait_for(self._done.wait(), timeout)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def make_products(count):
+    return [
+        {
+            "id": f"p{i:05d}",
+            "name": f"Товар {i}",
+            "price": 100 + i * 37 % 900,
+            "description": f"Описание товара {i}",
+            **({"photo_id": f"photo-{i}"} if i % 2 == 0 else {}),
+        }
+        for i in range(count)
+    ]
+
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+class Traffic:
+    """Генератор синтетических обновлений Telegram."""
+
+    def __init__(self):
+        self._update_ids = iter(range(1, sys.maxsize))
+
+    def callback(self, user_id, data):
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": make_user(user_id),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {"message_id": 1, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "bench"},
+            },
+        }
+
+    def command(self, user_id, command, document=None):
+        update_id = next(self._update_ids)
+        message = {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }
+        if document is not None:
+            # В Telegram команда с файлом приходит подписью; здесь текст и документ в одном сообщении,
+            # чтобы сработал CommandHandler
+            message["document"] = document
+        return {"update_id": update_id, "message": message}
+
+class Bench:
+    def __init__(self, bot, application, api, args):
+        self.bot = bot
+        self.application = application
+        self.api = api
+        self.args = args
+        self.traffic = Traffic()
+        self.tracker = LatencyTracker()
+        self.results = []
+        self.admin_ids = [ADMIN_BASE_ID + i for i in range(args.admins)]
+        self._client = None
+
+    async def replay(self, name, updates, timeout=600):
+        """Отправляет обновления на вебхук одновременно и ждёт их обработки."""
+        self.tracker.expect(len(updates))
+        calls_before = self.api.total_calls()
+        started = time.perf_counter()
+
+        async def post(update):
+            self.tracker.sent(update["update_id"])
+            response = await self._client.post(self.bot.WEBHOOK_PATH, json=update)
+            response.raise_for_status()
+
+        await asyncio.gather(*(post(update) for update in updates))
+        await self.tracker.wait(timeout)
+        self.report(name, self.tracker.latencies, time.perf_counter() - started, self.api.total_calls() - calls_before)
+
+    def report(self, name, latencies, elapsed, api_calls=0):
+        self.results.append({
+            "scenario": name,
+            "updates": len(latencies),
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "api_calls": api_calls,
+        })
+
+    async def orders(self):
+        products = self.bot.catalog.all()
+        updates = [
+            self.traffic.callback(BUYER_BASE_ID + user, self.bot.pack_callback(self.bot.CB_ORDER, products[(user + tap) % len(products)]["id"]))
+            for user in range(self.args.users)
+            for tap in range(self.args.taps)
+        ]
+        await self.replay("orders", updates)
+
+    async def status(self):
+        products = self.bot.catalog.all()
+        order_ids = []
+        for i in range(self.args.orders):
+            order_id = await self.bot.order_ids.next_id()
+            product = products[i % len(products)]
+            await self.bot.order_store.create(
+                order_id,
+                message_id=i + 1,
+                buyer_id=BUYER_BASE_ID + i,
+                product_id=product["id"],
+                product_name=product["name"],
+                product_price=product["price"],
+                username=f"user{BUYER_BASE_ID + i}",
+            )
+            order_ids.append(order_id)
+        # Разные админы одновременно берут заказ в работу и отмечают его проданным
+        updates = []
+        for i, order_id in enumerate(order_ids):
+            updates.append(self.traffic.callback(self.admin_ids[i % len(self.admin_ids)], self.bot.pack_callback(self.bot.CB_STATUS_PROCESSING, order_id)))
+            updates.append(self.traffic.callback(self.admin_ids[(i + 1) % len(self.admin_ids)], self.bot.pack_callback(self.bot.CB_STATUS_SOLD, order_id)))
+        await self.replay("status", updates)
+
+    async def upload(self):
+        document = {"file_id": "products.json", "file_unique_id": "products.json", "file_name": "products.json"}
+        self.api.files["products.json"] = json.dumps(make_products(self.args.products)).encode()
+        for name in (f"upload {self.args.products} (new)", f"upload {self.args.products} (unchanged)"):
+            texts_before, calls_before = len(self.api.texts), self.api.total_calls()
+            started = time.perf_counter()
+            await self.replay(name, [self.traffic.command(self.admin_ids[0], "/upload_json", document)])
+            # Хендлер отвечает сразу после замены каталога, посты в канале правит фоновая задача
+            await self.api.wait_for_text(texts_before, "Синхронизация канала: готово", timeout=600)
+            elapsed = time.perf_counter() - started
+            self.report(f"{name} sync", [elapsed], elapsed, self.api.total_calls() - calls_before)
+
+    async def load(self):
+        await self.bot.catalog.flush()
+        self.bot.atomic_write(self.bot.PRODUCTS_FILE, json.dumps(make_products(self.args.products), indent=2))
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(self.args.repeat):
+            load_started = time.perf_counter()
+            self.bot.catalog.load()
+            latencies.append(time.perf_counter() - load_started)
+        self.report(f"catalog load {self.args.products}", latencies, time.perf_counter() - started)
+
+    async def run(self, scenarios):
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        # Последняя группа хендлеров: к этому моменту обновление полностью обработано
+        self.application.add_handler(TypeHandler(Update, self.tracker.finished), group=99)
+        transport = httpx.ASGITransport(app=self.bot.create_web_app(self.application))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as self._client:
+            for name in SCENARIOS:
+                if name in scenarios:
+                    await getattr(self, name)()
+
+def lift_rate_limits(bot):
+    """Снимает лимиты Telegram: хендлеры берут ограничитель из глобальных переменных модуля."""
+    bot.PRIVATE_CHAT_RATE = bot.GROUP_CHAT_RATE = 1e9
+    limiter = bot.TelegramRateLimiter(global_rate=1e9)
+    bot.rate_limiter = limiter
+    bot.notifications = bot.NotificationDispatcher(limiter)
+    bot.channel_sync = bot.ChannelSync(limiter)
+    bot.outbox.limiter = limiter
+
+def print_table(results):
+    header = f"{'scenario':<32}{'updates':>9}{'seconds':>10}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'api calls':>11}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<32}{r['updates']:>9}{r['seconds']:>10.3f}{r['updates_per_sec']:>10.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['api_calls']:>11}"
+        )
+
+async def run_bench(args, workdir):
+    os.chdir(workdir)
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    port = free_port()
+    api_server = uvicorn.Server(uvicorn.Config(api.app(), host="127.0.0.1", port=port, log_level="warning"))
+    api_task = asyncio.get_running_loop().create_task(api_server.serve())
+    while not api_server.started:
+        await asyncio.sleep(0.01)
+
+    # Конфигурация bot.py читается при импорте, поэтому окружение задаётся до него
+    os.environ.pop("WEBHOOK_SECRET", None)
+    os.environ.update(
+        BOT_TOKEN=BENCH_TOKEN,
+        BOT_API_URL=f"http://127.0.0.1:{port}",
+        REQUEST_HTTP_VERSION="1.1",
+        STATE_BACKEND="files",
+        ORDERS_DB=os.path.join(workdir, "orders.db"),
+    )
+    import bot
+
+    admins = [{"user_id": admin_id, "role": "admin", "permissions": ["all"]} for admin_id in range(ADMIN_BASE_ID, ADMIN_BASE_ID + args.admins)]
+    bot.atomic_write(bot.ADMINS_FILE, json.dumps({"admins": admins}))
+    bot.atomic_write(bot.PRODUCTS_FILE, json.dumps(make_products(args.catalog)))
+    if not args.telegram_limits:
+        lift_rate_limits(bot)
+    bot.catalog.load()
+    bot.admin_registry.load()
+    bot.usernames.load()
+
+    application = bot.build_application()
+    bench = Bench(bot, application, api, args)
+    try:
+        async with application:
+            await application.start()
+            bot.outbox.start(application.bot)
+            try:
+                await bench.run(args.scenario)
+            finally:
+                await bot.outbox.stop()
+                await application.stop()
+    finally:
+        await bot.on_shutdown(application)
+        api_server.should_exit = True
+        await api_task
+    return bench.results
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальной заглушкой Bot API")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--users", type=int, default=200, help="покупателей в сценарии orders")
+    parser.add_argument("--taps", type=int, default=5, help="нажатий «Заказать» на покупателя")
+    parser.add_argument("--orders", type=int, default=500, help="заказов в сценарии status")
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--catalog", type=int, default=100, help="товаров в каталоге для заказов")
+    parser.add_argument("--products", type=int, default=10000, help="товаров в upload и load")
+    parser.add_argument("--repeat", type=int, default=20, help="повторов в сценарии load")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа заглушки Bot API, мс")
+    parser.add_argument("--telegram-limits", action="store_true", help="оставить лимиты Telegram на отправку")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        results = asyncio.run(run_bench(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,129 @@
+import time
+# Отсчёт холодного старта начинается до импортов: на них уходит заметная его часть
+BOOT_STARTED = time.perf_counter()
 import os
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import asyncio
+import tempfile
+import hashlib
+import io
+import html
+import itertools
+import math
+import bisect
+import re
+import zipfile
+import sqlite3
+import logging
+import pickle
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputMediaPhoto,
+    InputTextMessageContent,
+)
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     ConversationHandler,
     ContextTypes,
     filters,
 )
-from flask import Flask
-import threading
-
-# Мини Flask-сервер (Uptime Robot)
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "Bot is running!", 200
-
-def run():
-    app.run(host="0.0.0.0", port=8080)
-            
-def keep_alive():
-    thread = threading.Thread(target=run)
-    thread.start()
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
 # Конфигурация
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN")
+WEBHOOK_PATH = "/webhook"
+# Адрес Bot API: можно указать собственный сервер telegram-bot-api
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 PRODUCTS_CHANNEL = "@ShopProductsgg"
 ORDERS_CHANNEL = "@ShopOrdersgg"
 PRODUCTS_FILE = "products.json"
 ADMINS_FILE = "admins.json"
+USERNAMES_FILE = "usernames.json"
+ORDERS_DB = os.getenv("ORDERS_DB", "orders.db")
+# files — каталог и сотрудники в JSON-файлах (один процесс); sqlite — в общей БД STATE_DB
+STATE_BACKEND = os.getenv("STATE_BACKEND", "files")
+STATE_DB = os.getenv("STATE_DB", "state.db")
+# Внутренний адрес процесса: если задан, обновления одного чата обрабатывает один процесс
+WORKER_URL = os.getenv("WORKER_URL")
+WORKER_ID = os.getenv("WORKER_ID") or f"{os.uname().nodename}-{os.getpid()}"
+WORKER_SECRET = os.getenv("WORKER_SECRET", "")
+# Сколько обновлений разных пользователей обрабатывается одновременно
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+# Пулы соединений с Bot API: обычные запросы и загрузка/скачивание файлов отдельно
+REQUEST_POOL_SIZE = int(os.getenv("REQUEST_POOL_SIZE", 32))
+MEDIA_POOL_SIZE = int(os.getenv("MEDIA_POOL_SIZE", 8))
+# "2" — HTTP/2 по TLS (api.telegram.org); для локального Bot API по http нужен "1.1"
+REQUEST_HTTP_VERSION = os.getenv("REQUEST_HTTP_VERSION", "2")
+JOURNAL_FILE = "changes.log"
+# Снимок каталога и сотрудников для быстрого старта после простоя
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "state.snapshot")
 PHOTO, DESCRIPTION, PRICE, EMPLOYEE_ID, EMPLOYEE_ROLE, DELETE_PRODUCT, DELETE_EMPLOYEE = range(7)
 
+logger = logging.getLogger("shop_bot")
+
+# Метрики Prometheus
+CALLBACK_SECONDS = Histogram("bot_callback_seconds", "Время обработки нажатия кнопки", ["action"])
+API_REQUEST_SECONDS = Histogram("bot_api_request_seconds", "Время запроса к Bot API", ["method", "pool"])
+API_POOL_WAIT_SECONDS = Histogram(
+    "bot_api_pool_wait_seconds", "Ожидание свободного соединения с Bot API", ["pool"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+API_POOL_TIMEOUTS = Counter("bot_api_pool_timeouts_total", "Запросы, не дождавшиеся соединения", ["pool"])
+STORAGE_SECONDS = Histogram("bot_storage_seconds", "Чтение и запись каталога и сотрудников", ["operation"])
+ORDERS_TOTAL = Counter("bot_orders_total", "Оформленные заказы")
+API_RETRIES = Counter("bot_api_retries_total", "Повторы запросов к Bot API", ["reason"])
+FLOOD_WAITS = Counter("bot_flood_waits_total", "Ответы RetryAfter от Telegram")
+FLOOD_WAIT_SECONDS = Counter("bot_flood_wait_seconds_total", "Суммарная пауза по RetryAfter")
+DUPLICATES_SUPPRESSED = Counter("bot_duplicates_suppressed_total", "Отброшенные повторы", ["kind"])
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Длительность фаз последнего запуска", ["phase"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Необработанные ошибки в хендлерах")
+
 # Валидация JSON
-def validate_products(products):
-    if not isinstance(products, list):
-        return False
-    required_fields = ["id", "name", "price", "description"]
-    for product in products:
-        if not all(field in product for field in required_fields):
-            return False
-        if not isinstance(product["id"], str) or not isinstance(product["name"], str):
-            return False
-        try:
-            float(product["price"])
-        except (ValueError, TypeError):
-            return False
-    return True
+PRODUCT_FIELDS = ["id", "name", "price", "description"]
+
+def validate_product(product):
+    """Возвращает текст ошибки или None, если товар корректен."""
+    if not isinstance(product, dict):
+        return "ожидается объект"
+    missing = [field for field in PRODUCT_FIELDS if field not in product]
+    if missing:
+        return "нет полей: " + ", ".join(missing)
+    if not isinstance(product["id"], str) or not isinstance(product["name"], str):
+        return "id и name должны быть строками"
+    try:
+        float(product["price"])
+    except (ValueError, TypeError):
+        return "некорректная цена"
+    return None
+
+def validate_new_product(product):
+    """Проверка загружаемого или нового товара: вдобавок id должен поместиться в callback_data кнопок."""
+    error = validate_product(product)
+    if error is None and len(product["id"].encode()) > PRODUCT_ID_MAX_BYTES:
+        return f"id длиннее {PRODUCT_ID_MAX_BYTES} байт"
+    return error
 
 def validate_admins(admins):
     if not isinstance(admins, dict) or "admins" not in admins:
@@ -66,96 +141,2496 @@ def validate_admins(admins):
             return False
     return True
 
-# Работа с JSON
-def load_products():
+# Потоковое чтение товаров: массив JSON или NDJSON (по объекту в строке)
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_MAX_ERRORS = 20
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+JSON_NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+def iter_json_array(f, chunk_size=IMPORT_CHUNK_SIZE):
+    """Разбирает JSON-массив по одному элементу, не загружая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    def check_end():
+        # После закрывающей скобки допускаются только пробелы
+        nonlocal pos
+        pos += 1
+        skip_whitespace()
+        if pos < len(buffer):
+            raise ValueError("лишние данные после массива товаров")
+
+    while True:
+        skip_whitespace()
+        if pos >= len(buffer):
+            raise ValueError("неожиданный конец файла")
+        char = buffer[pos]
+        if not started:
+            if char != "[":
+                raise ValueError("ожидается массив товаров")
+            started = True
+            pos += 1
+            skip_whitespace()
+            if buffer[pos:pos + 1] == "]":
+                check_end()
+                return
+            continue
+        if char == "-" or char.isdigit():
+            # Число на границе куска могло обрезаться («1.» от «1.5» разберётся как 1): дочитываем до его конца
+            end = pos
+            while end < len(buffer) and buffer[end] in JSON_NUMBER_CHARS:
+                end += 1
+            if end == len(buffer) and not eof:
+                fill()
+                continue
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Объект мог не поместиться в прочитанный кусок — дочитываем и пробуем снова
+            if eof:
+                raise
+            fill()
+            continue
+        pos = end
+        yield item
+        skip_whitespace()
+        if buffer[pos:pos + 1] == "]":
+            check_end()
+            return
+        if buffer[pos:pos + 1] != ",":
+            raise ValueError("ожидается ',' или ']' после товара")
+        pos += 1
+        skip_whitespace()
+        if buffer[pos:pos + 1] == "]":
+            raise ValueError("лишняя запятая перед ']'")
+
+def iter_ndjson(f):
+    """Записи NDJSON по строкам; вместо испорченной строки — JSONDecodeError, чтобы её ошибка попала в отчёт."""
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield e
+
+def import_products(path, ndjson=False):
+    """Читает и проверяет товары по одному; возвращает (товары, ошибки, число ошибок)."""
+    products = []
+    errors = []
+    error_count = 0
+    seen_ids = set()
+    with open(path, "r") as f:
+        records = iter_ndjson(f) if ndjson else iter_json_array(f)
+        for number, product in enumerate(records, start=1):
+            if isinstance(product, json.JSONDecodeError):
+                error = f"некорректный JSON: {product.msg}"
+            else:
+                error = validate_new_product(product)
+            if error is None and product["id"] in seen_ids:
+                error = f"повторяется id {product['id']}"
+            if error is not None:
+                error_count += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append(f"#{number}: {error}")
+                continue
+            seen_ids.add(product["id"])
+            products.append(product)
+    return products, errors, error_count
+
+# Атомарная запись файла: временный файл рядом + rename
+def atomic_write(path, payload):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix="_" + os.path.basename(path))
     try:
-        with open(PRODUCTS_FILE, "r") as f:
-            products = json.load(f)
-            if not validate_products(products):
-                print("Invalid products.json, creating empty")
-                products = []
-                save_products(products)
-            return products
-    except (FileNotFoundError, json.JSONDecodeError):
-        products = []
-        save_products(products)
-        return products
-
-def save_products(products):
-    with open(PRODUCTS_FILE, "w") as f:
-        json.dump(products, f, indent=2)
+        with os.fdopen(fd, "wb" if isinstance(payload, bytes) else "w") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# SQLite в режиме WAL
+class SQLiteDatabase:
+    """Соединение с SQLite; все запросы идут через один поток-исполнитель, event loop не блокируется."""
+
+    schema = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{os.path.basename(path)}")
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(self.schema)
+            self._conn = conn
+            self._migrate(conn)
+        return self._conn
+
+    def _migrate(self, conn):
+        """Вызывается после создания схемы; наследники дописывают данные для новых таблиц."""
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _call(self, fn, *args):
+        # Синхронный вызов из кода без event loop или для коротких запросов
+        return self._executor.submit(fn, *args).result()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+# Хранилище общего состояния: каталог и сотрудники как документы
+STATE_RECHECK_INTERVAL = 2.0
+PERSISTENCE_INTERVAL = 5
+WORKER_HEARTBEAT_INTERVAL = 10
+WORKER_TTL = 30
+
+class FileStateBackend:
+    """Документы в JSON-файлах на локальном диске — подходит только для одного процесса."""
+
+    shared = False
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def read(self, name):
+        try:
+            with open(self.paths[name], "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, payload):
+        atomic_write(self.paths[name], payload)
+        return self.version(name)
+
+    def write_if(self, name, payload, expected_version):
+        # Один процесс — сверять версию не с кем
+        return self.write(name, payload)
+
+    def read_versioned(self, name):
+        return self.read(name), self.version(name)
+
+    def version(self, name):
+        try:
+            return os.stat(self.paths[name]).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Асинхронные варианты для кода внутри event loop: файловые операции уходят в поток
+    async def fetch(self, name):
+        return await asyncio.to_thread(self.read_versioned, name)
+
+    async def fetch_version(self, name):
+        return await asyncio.to_thread(self.version, name)
+
+    async def close(self):
+        pass
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_data (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+class SQLiteStateBackend(SQLiteDatabase):
+    """Общее состояние нескольких процессов бота: документы, user_data/chat_data, диалоги, реестр процессов."""
+
+    shared = True
+    schema = STATE_SCHEMA
+
+    def _read(self, name):
+        row = self._db().execute("SELECT body FROM documents WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, name, payload):
+        row = self._db().execute(
+            "INSERT INTO documents (name, version, body) VALUES (?, 1, ?) "
+            "ON CONFLICT (name) DO UPDATE SET version = version + 1, body = excluded.body "
+            "RETURNING version",
+            (name, payload),
+        ).fetchone()
+        return row[0]
+
+    def _write_if(self, name, payload, expected_version):
+        # Запись только поверх версии expected_version (None — документа ещё нет); при конфликте None
+        if expected_version is None:
+            row = self._db().execute(
+                "INSERT INTO documents (name, version, body) VALUES (?, 1, ?) "
+                "ON CONFLICT (name) DO NOTHING RETURNING version",
+                (name, payload),
+            ).fetchone()
+        else:
+            row = self._db().execute(
+                "UPDATE documents SET version = version + 1, body = ? "
+                "WHERE name = ? AND version = ? RETURNING version",
+                (payload, name, expected_version),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _read_versioned(self, name):
+        row = self._db().execute("SELECT body, version FROM documents WHERE name = ?", (name,)).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def _version(self, name):
+        row = self._db().execute("SELECT version FROM documents WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def read(self, name):
+        return self._call(self._read, name)
+
+    def write(self, name, payload):
+        return self._call(self._write, name, payload)
+
+    def write_if(self, name, payload, expected_version):
+        return self._call(self._write_if, name, payload, expected_version)
+
+    def read_versioned(self, name):
+        return self._call(self._read_versioned, name)
+
+    def version(self, name):
+        return self._call(self._version, name)
+
+    # Синхронные методы выше — для запуска и потоков; в event loop только эти
+    async def fetch(self, name):
+        return await self._run(self._read_versioned, name)
+
+    async def fetch_version(self, name):
+        return await self._run(self._version, name)
+
+    # Данные PTB (user_data, chat_data) — по строке на пользователя/чат с номером версии
+    def _load_rows(self, table):
+        rows = self._db().execute(f"SELECT id, version, data FROM {table}").fetchall()
+        return {row["id"]: (row["version"], json.loads(row["data"])) for row in rows}
+
+    def _load_row_if_newer(self, table, row_id, version):
+        row = self._db().execute(
+            f"SELECT version, data FROM {table} WHERE id = ? AND version > ?", (row_id, version)
+        ).fetchone()
+        return (row["version"], json.loads(row["data"])) if row else None
+
+    def _save_row(self, table, row_id, payload):
+        row = self._db().execute(
+            f"INSERT INTO {table} (id, version, data) VALUES (?, 1, ?) "
+            "ON CONFLICT (id) DO UPDATE SET version = version + 1, data = excluded.data "
+            "RETURNING version",
+            (row_id, payload),
+        ).fetchone()
+        return row[0]
+
+    def _delete_row(self, table, row_id):
+        self._db().execute(f"DELETE FROM {table} WHERE id = ?", (row_id,))
+
+    def _load_conversations(self, name):
+        rows = self._db().execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(row["key"])): json.loads(row["state"]) for row in rows}
+
+    def _save_conversation(self, name, key, state):
+        if state is None:
+            self._db().execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+        else:
+            self._db().execute(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)", (name, key, state)
+            )
+
+    def _heartbeat(self, worker_id, url, ttl):
+        now = time.time()
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO workers (worker_id, url, heartbeat) VALUES (?, ?, ?)", (worker_id, url, now))
+        rows = db.execute("SELECT worker_id, url FROM workers WHERE heartbeat > ?", (now - ttl,)).fetchall()
+        return [(row["worker_id"], row["url"]) for row in rows]
+
+    def _unregister(self, worker_id):
+        self._db().execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    async def load_rows(self, table):
+        return await self._run(self._load_rows, table)
+
+    async def load_row_if_newer(self, table, row_id, version):
+        return await self._run(self._load_row_if_newer, table, row_id, version)
+
+    async def save_row(self, table, row_id, data):
+        return await self._run(self._save_row, table, row_id, json.dumps(data))
+
+    async def delete_row(self, table, row_id):
+        await self._run(self._delete_row, table, row_id)
+
+    async def load_conversations(self, name):
+        return await self._run(self._load_conversations, name)
+
+    async def save_conversation(self, name, key, state):
+        payload = None if state is None else json.dumps(state)
+        await self._run(self._save_conversation, name, json.dumps(list(key)), payload)
+
+    async def heartbeat(self, worker_id, url, ttl):
+        """Отмечает процесс живым; возвращает список живых процессов [(worker_id, url)]."""
+        return await self._run(self._heartbeat, worker_id, url, ttl)
+
+    async def unregister(self, worker_id):
+        await self._run(self._unregister, worker_id)
+
+def make_state_backend():
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateBackend(STATE_DB)
+    if STATE_BACKEND != "files":
+        raise ValueError(f"Неизвестный STATE_BACKEND: {STATE_BACKEND}")
+    return FileStateBackend({"products": PRODUCTS_FILE, "admins": ADMINS_FILE, "usernames": USERNAMES_FILE})
+
+state = make_state_backend()
+
+class SQLitePersistence(BasePersistence):
+    """Persistence для PTB: user_data, chat_data и состояния диалогов в общей SQLite.
+
+    Перед обработкой обновления user_data/chat_data подтягиваются из БД, если их успел
+    изменить другой процесс (сравнение по номеру версии строки).
+    """
+
+    def __init__(self, backend, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.backend = backend
+        self._versions = {}
+
+    async def _load(self, table):
+        rows = await self.backend.load_rows(table)
+        for row_id, (version, _) in rows.items():
+            self._versions[(table, row_id)] = version
+        return {row_id: data for row_id, (_, data) in rows.items()}
+
+    async def _save(self, table, row_id, data):
+        self._versions[(table, row_id)] = await self.backend.save_row(table, row_id, data)
+
+    async def _refresh(self, table, row_id, data):
+        row = await self.backend.load_row_if_newer(table, row_id, self._versions.get((table, row_id), 0))
+        if row is not None:
+            self._versions[(table, row_id)], fresh = row
+            data.clear()
+            data.update(fresh)
+
+    async def _drop(self, table, row_id):
+        self._versions.pop((table, row_id), None)
+        await self.backend.delete_row(table, row_id)
+
+    async def get_user_data(self):
+        return await self._load("user_data")
+
+    async def get_chat_data(self):
+        return await self._load("chat_data")
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await self.backend.load_conversations(name)
+
+    async def update_conversation(self, name, key, new_state):
+        await self.backend.save_conversation(name, key, new_state)
+
+    async def update_user_data(self, user_id, data):
+        await self._save("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._save("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._drop("user_data", user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop("chat_data", chat_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user_data", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat_data", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+# Ключ упорядочивания обновлений: пользователь, иначе чат.
+# Нажатия «Заказать» в канале приходят от разных пользователей, но из одного чата —
+# по чату они бы выстроились в одну очередь.
+def update_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно, одного пользователя — строго по очереди.
+
+    Пока обновление пользователя обрабатывается, следующие встают в его очередь и не занимают
+    слоты max_concurrent_updates; их выполняет та же задача по порядку поступления.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await coroutine
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        self._queues[key] = queue = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    logger.error(f"Ошибка обработки обновления: {e}")
+        finally:
+            del self._queues[key]
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        while self._queues:
+            await asyncio.sleep(0.05)
+
+# Привязка чатов к процессам
+
+class WorkerAffinity:
+    """Все обновления одного пользователя (чата) обрабатывает один процесс — rendezvous hashing по живым процессам.
+
+    Процессы отмечаются в общей БД; вебхук, попавший «не туда», пересылается владельцу.
+    Если владелец недоступен, обновление обрабатывается на месте.
+    """
+
+    def __init__(self, backend, worker_id, url, heartbeat_interval=WORKER_HEARTBEAT_INTERVAL, ttl=WORKER_TTL):
+        self.backend = backend
+        self.worker_id = worker_id
+        self.url = url.rstrip("/")
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self._workers = [(worker_id, self.url)]
+        self._client = None
+        self._task = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=5)
+        self._workers = await self.backend.heartbeat(self.worker_id, self.url, self.ttl)
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.backend.unregister(self.worker_id)
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self._workers = await self.backend.heartbeat(self.worker_id, self.url, self.ttl)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка обновления списка процессов: {e}")
+
+    def owner(self, key):
+        return max(
+            self._workers,
+            key=lambda worker: hashlib.sha1(f"{worker[0]}:{key}".encode()).digest(),
+        )
+
+    async def forward(self, update: Update, data):
+        """Пересылает обновление владельцу чата; True, если его обработает другой процесс."""
+        key = update_key(update)
+        if key is None:
+            return False
+        worker_id, url = self.owner(key)
+        if worker_id == self.worker_id:
+            return False
+        headers = {"X-Worker-Forwarded": self.worker_id, "X-Worker-Secret": WORKER_SECRET}
+        if WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+        try:
+            response = await self._client.post(url + WEBHOOK_PATH, json=data, headers=headers)
+        except httpx.HTTPError as e:
+            logger.error(f"Процесс {worker_id} недоступен, обрабатываем сами: {e}")
+            return False
+        return response.status_code == 200
+
+# Каталог товаров в памяти
+CARD_FIELDS = ("id", "name", "price", "description")
+SEARCH_FIELDS = ("name", "description")
+
+def search_tokens(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+class ProductSearchIndex:
+    """Поиск по словам названия и описания.
+
+    Слово → множество id товаров; слова хранятся отсортированными, поэтому все слова
+    с заданным префиксом находятся бинарным поиском, без перебора каталога.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._words = []
+        self._product_words = {}
+
+    def rebuild(self, products):
+        self._postings = {}
+        self._product_words = {}
+        for product in products:
+            words = search_tokens(" ".join(str(product.get(field, "")) for field in SEARCH_FIELDS))
+            self._product_words[product["id"]] = words
+            for word in words:
+                self._postings.setdefault(word, set()).add(product["id"])
+        self._words = sorted(self._postings)
+
+    def add(self, product):
+        self.remove(product["id"])
+        words = search_tokens(" ".join(str(product.get(field, "")) for field in SEARCH_FIELDS))
+        self._product_words[product["id"]] = words
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                ids = self._postings[word] = set()
+                bisect.insort(self._words, word)
+            ids.add(product["id"])
+
+    def remove(self, product_id):
+        for word in self._product_words.pop(product_id, ()):
+            ids = self._postings[word]
+            ids.discard(product_id)
+            if not ids:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+    def _prefix_ids(self, prefix):
+        ids = set()
+        start = bisect.bisect_left(self._words, prefix)
+        for word in itertools.islice(self._words, start, None):
+            if not word.startswith(prefix):
+                break
+            ids |= self._postings[word]
+        return ids
+
+    def search(self, text):
+        """id товаров, в которых каждое слово запроса — начало какого-нибудь слова."""
+        result = None
+        for prefix in sorted(search_tokens(text), key=len, reverse=True):
+            ids = self._prefix_ids(prefix)
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result or set()
+
+def merge_records(records, changes, key=lambda record: record["id"]):
+    """Накладывает changes ({ключ: запись или None, если удалена}) на список записей, сохраняя порядок."""
+    merged = [changes.get(key(record), record) for record in records]
+    known = {key(record) for record in records}
+    merged += [record for record_key, record in changes.items() if record_key not in known]
+    return [record for record in merged if record is not None]
+
+class ProductCatalog:
+    """Каталог товаров: читается из хранилища один раз, изменения пишутся в фоне пачками.
+
+    С общим хранилищем (несколько процессов) каталог раз в recheck_interval сверяет в фоне
+    версию документа и перечитывается, если его изменил другой процесс; до этого читатели
+    получают закэшированные товары. Запись идёт
+    только поверх прочитанной версии; если документ успели поменять, свои изменения
+    накладываются на свежую версию и запись повторяется.
+    """
+
+    def __init__(self, backend, name="products", flush_delay=0.5, recheck_interval=STATE_RECHECK_INTERVAL):
+        self.backend = backend
+        self.name = name
+        self.flush_delay = flush_delay
+        self.recheck_interval = recheck_interval
+        self._backend_version = None
+        self._checked_at = 0.0
+        self._products = []
+        self._index = {}
+        self._sorted_ids = []
+        self._search = ProductSearchIndex()
+        self._versions = {}
+        self._version_counter = itertools.count(1)
+        self._loaded = False
+        self._dirty = False
+        self._changed = set()
+        self._flush_task = None
+        self._recheck_task = None
+
+    def load(self):
+        with STORAGE_SECONDS.labels("catalog_load").time():
+            self._load()
+
+    def _parse(self, payload):
+        # Товары из документа или None, если документа нет или он испорчен
+        try:
+            products = json.loads(payload) if payload is not None else None
+        except json.JSONDecodeError:
+            return None
+        if products is None:
+            return None
+        if not isinstance(products, list):
+            logger.warning(f"Invalid {self.name}")
+            return None
+        # Испорченная запись не должна стоить всего каталога: пропускаем только её
+        valid = [product for product in products if validate_product(product) is None]
+        if len(valid) < len(products):
+            logger.warning(f"{self.name}: пропущено некорректных товаров: {len(products) - len(valid)}")
+        return valid
+
+    def _load(self):
+        payload, self._backend_version = self.backend.read_versioned(self.name)
+        self._checked_at = time.monotonic()
+        products = self._parse(payload)
+        if products is None:
+            self._set([])
+            self._dirty = True
+            self.flush_now()
+        else:
+            self._set(products)
+
+    def restore(self, products, version):
+        """Загружает товары из снимка, записанного при версии документа version."""
+        self._set(products)
+        self._backend_version = version
+        self._checked_at = time.monotonic()
+
+    def snapshot_state(self):
+        """(товары, версия документа) для снимка или None, если есть незаписанные изменения."""
+        if not self._loaded or self._dirty:
+            return None
+        return self._snapshot(), self._backend_version
+
+    def _set(self, products):
+        self._products = list(products)
+        self._index = {p["id"]: p for p in self._products}
+        self._sorted_ids = sorted(self._index)
+        self._search.rebuild(self._products)
+        self._versions = {p["id"]: next(self._version_counter) for p in self._products}
+        self._changed = set()
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+        elif self.backend.shared and time.monotonic() - self._checked_at >= self.recheck_interval:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._checked_at = time.monotonic()
+            if self._recheck_task is None or self._recheck_task.done():
+                self._recheck_task = loop.create_task(self._recheck())
+
+    def _writing(self):
+        return self._dirty or (self._flush_task is not None and not self._flush_task.done())
+
+    async def _recheck(self):
+        # Свои незаписанные правки сольются с чужими при записи, перечитывать не нужно
+        if self._writing():
+            return
+        try:
+            if await self.backend.fetch_version(self.name) == self._backend_version:
+                return
+            payload, version = await self.backend.fetch(self.name)
+            products = await asyncio.to_thread(self._parse, payload)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Ошибка чтения {self.name}: {e}")
+            return
+        if products is None or self._writing():
+            return
+        self._set(products)
+        self._backend_version = version
+        product_cards.invalidate()
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._products)
+
+    def all(self):
+        self._ensure_loaded()
+        return list(self._products)
+
+    def get(self, product_id):
+        self._ensure_loaded()
+        return self._index.get(product_id)
+
+    def page(self, after=None, before=None, limit=10):
+        """Страница товаров по возрастанию id: после курсора after или перед курсором before.
+
+        Возвращает (товары, позиция первого товара, есть ли товары раньше, есть ли позже).
+        """
+        self._ensure_loaded()
+        ids = self._sorted_ids
+        if before is not None:
+            end = bisect.bisect_left(ids, before)
+            start = max(0, end - limit)
+        else:
+            start = bisect.bisect_right(ids, after) if after is not None else 0
+            end = min(len(ids), start + limit)
+        return [self._index[i] for i in ids[start:end]], start, start > 0, end < len(ids)
+
+    def search(self, text, after=None, limit=50):
+        """Товары, подходящие под запрос, по возрастанию id после курсора after: (товары, следующий курсор)."""
+        self._ensure_loaded()
+        if not search_tokens(text):
+            products, _, _, has_next = self.page(after=after, limit=limit)
+            return products, products[-1]["id"] if has_next else None
+        ids = sorted(i for i in self._search.search(text) if after is None or i > after)
+        products = [self._index[i] for i in ids[:limit]]
+        return products, products[-1]["id"] if len(ids) > limit else None
+
+    def version(self, product_id):
+        """Номер версии товара: меняется при каждой правке видимых полей."""
+        return self._versions.get(product_id)
+
+    def next_id(self):
+        """Свободный id для нового товара: на единицу больше наибольшего числового."""
+        self._ensure_loaded()
+        return f"{max((int(i) for i in self._index if i.isdigit()), default=0) + 1:03d}"
+
+    def add(self, product):
+        """Добавляет новый товар; товар с тем же id не заменяется — ValueError."""
+        self._ensure_loaded()
+        if product["id"] in self._index:
+            raise ValueError(f"товар {product['id']} уже есть в каталоге")
+        bisect.insort(self._sorted_ids, product["id"])
+        self._products.append(product)
+        self._index[product["id"]] = product
+        self._search.add(product)
+        self._versions[product["id"]] = next(self._version_counter)
+        self._mark_changed([product["id"]])
+        self.schedule_flush()
+
+    def update(self, product_id, **fields):
+        product = self.get(product_id)
+        if product is None:
+            return None
+        product.update(fields)
+        if any(field in CARD_FIELDS for field in fields):
+            self._versions[product_id] = next(self._version_counter)
+        if any(field in SEARCH_FIELDS for field in fields):
+            self._search.add(product)
+        self._mark_changed([product_id])
+        self.schedule_flush()
+        return product
+
+    def remove(self, product_id):
+        self._ensure_loaded()
+        product = self._index.pop(product_id, None)
+        if product is not None:
+            self._products = [p for p in self._products if p["id"] != product_id]
+            del self._sorted_ids[bisect.bisect_left(self._sorted_ids, product_id)]
+            self._search.remove(product_id)
+            self._versions.pop(product_id, None)
+            product_cards.invalidate(product_id)
+            self._mark_changed([product_id])
+            self.schedule_flush()
+        return product
+
+    def update_many(self, changes):
+        """Правит несколько товаров разом ({id: {поле: значение}}); на диск — одна запись."""
+        self._ensure_loaded()
+        updated = []
+        for product_id, fields in changes.items():
+            product = self._index.get(product_id)
+            if product is None:
+                continue
+            product.update(fields)
+            if any(field in CARD_FIELDS for field in fields):
+                self._versions[product_id] = next(self._version_counter)
+            if any(field in SEARCH_FIELDS for field in fields):
+                self._search.add(product)
+            updated.append(product)
+        if updated:
+            self._mark_changed(product["id"] for product in updated)
+            self.schedule_flush()
+        return updated
+
+    def remove_many(self, product_ids):
+        """Удаляет несколько товаров за один проход по каталогу; возвращает удалённые."""
+        self._ensure_loaded()
+        removed = [self._index.pop(product_id) for product_id in set(product_ids) if product_id in self._index]
+        if not removed:
+            return []
+        ids = {product["id"] for product in removed}
+        self._products = [p for p in self._products if p["id"] not in ids]
+        self._sorted_ids = [i for i in self._sorted_ids if i not in ids]
+        for product_id in ids:
+            self._search.remove(product_id)
+            self._versions.pop(product_id, None)
+            product_cards.invalidate(product_id)
+        self._mark_changed(ids)
+        self.schedule_flush()
+        return removed
+
+    def replace(self, products):
+        self._set(products)
+        self._changed = None
+        product_cards.invalidate()
+        self.schedule_flush()
+
+    def _mark_changed(self, product_ids):
+        # None — каталог заменён целиком, отдельные id не нужны
+        if self._changed is not None:
+            self._changed.update(product_ids)
+
+    # Отложенная запись: всплеск изменений превращается в одну запись файла
+    def schedule_flush(self):
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    def _snapshot(self):
+        # Копии словарей: сериализация идёт в потоке, пока товары могут меняться
+        return [dict(p) for p in self._products]
+
+    def _take_changes(self):
+        """Снимок каталога и изменённые с прошлой записи товары (None — каталог заменён целиком)."""
+        changed, self._changed = self._changed, set()
+        if changed is not None:
+            changed = {i: dict(self._index[i]) if i in self._index else None for i in changed}
+        return self._snapshot(), changed
+
+    def _keep_changes(self, changes):
+        # Запись не удалась — изменения уйдут со следующей
+        if changes is None or self._changed is None:
+            self._changed = None
+        else:
+            self._changed.update(changes)
+
+    def _write(self, snapshot, changes, expected_version):
+        """Пишет документ поверх версии expected_version; возвращает (новая версия, товары после слияния или None)."""
+        merged = None
+        with STORAGE_SECONDS.labels("catalog_save").time():
+            while True:
+                version = self.backend.write_if(self.name, json.dumps(snapshot, indent=2), expected_version)
+                if version is not None:
+                    return version, merged
+                payload, expected_version = self.backend.read_versioned(self.name)
+                if changes is not None:
+                    remote = json.loads(payload) if payload is not None else []
+                    merged = snapshot = merge_records(remote, changes)
+
+    def _apply_write(self, version, merged):
+        self._backend_version = version
+        self._checked_at = time.monotonic()
+        if merged is None or self._changed is None:
+            return
+        # Документ менял другой процесс: берём слитую версию и поверх — правки, сделанные во время записи
+        changed, index = self._changed, self._index
+        self._set(merge_records(merged, {i: index.get(i) for i in changed}))
+        self._changed = changed
+        product_cards.invalidate()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        while self._dirty:
+            if not await self._flush_once():
+                return
+
+    async def _flush_once(self):
+        self._dirty = False
+        snapshot, changes = self._take_changes()
+        try:
+            result = await asyncio.to_thread(self._write, snapshot, changes, self._backend_version)
+        except (OSError, sqlite3.Error, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка записи {self.name}: {e}")
+            self._keep_changes(changes)
+            self._dirty = True
+            return False
+        self._apply_write(*result)
+        return True
+
+    def flush_now(self):
+        if self._dirty:
+            self._dirty = False
+            snapshot, changes = self._take_changes()
+            self._apply_write(*self._write(snapshot, changes, self._backend_version))
+
+    async def flush(self):
+        """Дожидается фоновой записи и сбрасывает оставшиеся изменения."""
+        task = self._flush_task
+        if task is not None and not task.done():
+            await task
+        if self._dirty:
+            await self._flush_once()
+
+catalog = ProductCatalog(state)
+
+# Работа с JSON
+# Сотрудники и права доступа
+DEFAULT_ADMINS = [{"user_id": 7652639453, "role": "admin", "permissions": ["all"]}]
+
+def admin_key(user_id):
+    """Приводит ID сотрудника к единому виду: число или '@username' в нижнем регистре."""
+    if isinstance(user_id, int):
+        return user_id
+    text = str(user_id).strip()
+    if text.lstrip("-").isdigit():
+        return int(text)
+    return "@" + text.lstrip("@").lower()
+
+# Соответствие @username → user_id, выученное из входящих обновлений
+USERNAME_CACHE_SIZE = 10000
+USERNAME_FLUSH_DELAY = 5
+
+class UsernameResolver:
+    """LRU-кэш username → user_id с отложенной записью в хранилище.
+
+    Telegram не отдаёт id по username, поэтому соответствия берутся из обновлений:
+    каждый, кто пишет боту или нажимает кнопку, попадает в кэш. Запись идёт поверх
+    прочитанной версии документа: соответствия, выученные другими процессами, не теряются.
+    """
+
+    def __init__(self, backend, name="usernames", capacity=USERNAME_CACHE_SIZE, flush_delay=USERNAME_FLUSH_DELAY):
+        self.backend = backend
+        self.name = name
+        self.capacity = capacity
+        self.flush_delay = flush_delay
+        self._ids = OrderedDict()
+        self._changed = {}
+        self._version = None
+        self._loaded = False
+        self._dirty = False
+        self._flush_task = None
+
+    def load(self):
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        payload, self._version = self.backend.read_versioned(self.name)
+        self._ids = self._parse(payload)
+
+    def _parse(self, payload):
+        try:
+            pairs = json.loads(payload)["usernames"] if payload is not None else []
+            return OrderedDict((str(name), int(user_id)) for name, user_id in pairs)
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            logger.warning(f"Invalid {self.name}, starting empty")
+            return OrderedDict()
+
+    def _merge(self, ids, changes):
+        # Выученные здесь соответствия — самые свежие: в конец LRU, лишние старые вытесняются
+        for key, user_id in changes.items():
+            ids[key] = user_id
+            ids.move_to_end(key)
+        while len(ids) > self.capacity:
+            ids.popitem(last=False)
+        return ids
+
+    def get(self, username):
+        self._ensure_loaded()
+        return self._ids.get(admin_key(username))
+
+    def learn(self, username, user_id):
+        self._ensure_loaded()
+        key = admin_key(username)
+        if self._ids.get(key) == user_id:
+            self._ids.move_to_end(key)
+            return
+        self._ids[key] = user_id
+        self._ids.move_to_end(key)
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+        self._changed.pop(key, None)
+        self._changed[key] = user_id
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def rewrite(self, admins):
+        """Заменяет известные '@username' в списке сотрудников числовыми id."""
+        self._ensure_loaded()
+        known = {admin_key(a["user_id"]) for a in admins}
+        result = []
+        for admin in admins:
+            key = admin_key(admin["user_id"])
+            user_id = self._ids.get(key) if isinstance(key, str) else None
+            if user_id is not None:
+                if user_id in known:
+                    continue
+                known.add(user_id)
+                admin = dict(admin, user_id=user_id)
+            result.append(admin)
+        return result
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    def _write(self, pairs, changes, expected_version):
+        """Пишет соответствия поверх версии expected_version; возвращает (новая версия, соответствия после слияния или None)."""
+        merged = None
+        while True:
+            version = self.backend.write_if(self.name, json.dumps({"usernames": pairs}), expected_version)
+            if version is not None:
+                return version, merged
+            payload, expected_version = self.backend.read_versioned(self.name)
+            merged = self._merge(self._parse(payload), changes)
+            pairs = [[name, user_id] for name, user_id in merged.items()]
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        changes, self._changed = self._changed, {}
+        pairs = [[name, user_id] for name, user_id in self._ids.items()]
+        try:
+            version, merged = await asyncio.to_thread(self._write, pairs, changes, self._version)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Ошибка записи {self.name}: {e}")
+            self._changed = {**changes, **self._changed}
+            self._dirty = True
+            return
+        self._version = version
+        if merged is not None:
+            # Заодно получаем соответствия других процессов; поверх — выученные во время записи
+            self._ids = self._merge(merged, self._changed)
+
+def admin_record_key(admin):
+    return admin_key(admin["user_id"])
+
+class AdminRegistry:
+    """Кэш сотрудников с индексом прав по user_id.
+
+    save() меняет кэш сразу, а в хранилище пишет в фоне. Смену версии документа
+    (mtime файла или версию в SQLite) кэш сверяет в фоновой задаче раз в recheck_interval.
+    Как и каталог, запись идёт только поверх прочитанной версии: если документ успел
+    поменять другой процесс, изменённые этим процессом сотрудники накладываются на свежую версию.
+    """
+
+    def __init__(self, backend, name="admins", recheck_interval=STATE_RECHECK_INTERVAL):
+        self.backend = backend
+        self.name = name
+        self.recheck_interval = recheck_interval
+        self._admins = []
+        self._permissions = {}
+        self._pending_usernames = set()
+        self._version = None
+        self._checked_at = None
+        self._dirty = False
+        self._changed = set()
+        self._flush_task = None
+        self._recheck_task = None
+
+    def load(self):
+        with STORAGE_SECONDS.labels("admins_load").time():
+            self._load()
+
+    def _load(self):
+        payload, version = self.backend.read_versioned(self.name)
+        try:
+            data = json.loads(payload) if payload is not None else None
+            if validate_admins(data):
+                self._set(data["admins"])
+                self._version = version
+                return
+            if data is not None:
+                logger.warning(f"Invalid {self.name}, creating default")
+        except json.JSONDecodeError:
+            pass
+        self.save([dict(a) for a in DEFAULT_ADMINS])
+
+    def restore(self, admins, version):
+        self._set(admins)
+        self._version = version
+
+    def snapshot_state(self):
+        if self._version is None or self._dirty:
+            return None
+        return [dict(a) for a in self._admins], self._version
+
+    def save(self, admins):
+        # Запоминаем, каких сотрудников коснулось изменение: только они накладываются на чужую версию
+        previous, current = self._by_key(self._admins), self._by_key(admins)
+        self._changed.update(key for key in previous.keys() | current.keys() if previous.get(key) != current.get(key))
+        self._set(admins)
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._dirty = False
+            self._apply_write(*self._write(*self._take_changes(), self._version))
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_pending())
+
+    @staticmethod
+    def _by_key(admins):
+        result = {}
+        for admin in admins:
+            result.setdefault(admin_record_key(admin), admin)
+        return result
+
+    def _take_changes(self):
+        current = self._by_key(self._admins)
+        changes = {key: current.get(key) for key in self._changed}
+        self._changed = set()
+        return [dict(a) for a in self._admins], changes
+
+    def _write(self, admins, changes, expected_version):
+        """Пишет список поверх версии expected_version; возвращает (новая версия, список после слияния или None)."""
+        merged = None
+        with STORAGE_SECONDS.labels("admins_save").time():
+            while True:
+                version = self.backend.write_if(self.name, json.dumps({"admins": admins}, indent=2), expected_version)
+                if version is not None:
+                    return version, merged
+                payload, expected_version = self.backend.read_versioned(self.name)
+                try:
+                    data = json.loads(payload) if payload is not None else None
+                except json.JSONDecodeError:
+                    data = None
+                remote = data["admins"] if validate_admins(data) else []
+                merged = admins = merge_records(remote, changes, key=admin_record_key)
+
+    def _apply_write(self, version, merged):
+        self._version = version
+        if merged is None:
+            return
+        # Поверх слитого списка — правки, сделанные во время записи
+        current = self._by_key(self._admins)
+        self._set(merge_records(merged, {key: current.get(key) for key in self._changed}, key=admin_record_key))
+
+    async def _flush_pending(self):
+        while self._dirty:
+            self._dirty = False
+            admins, changes = self._take_changes()
+            try:
+                result = await asyncio.to_thread(self._write, admins, changes, self._version)
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Ошибка записи {self.name}: {e}")
+                self._changed.update(changes)
+                self._dirty = True
+                return
+            self._apply_write(*result)
+
+    async def flush(self):
+        """Дожидается фоновой записи и сбрасывает оставшиеся изменения."""
+        task = self._flush_task
+        if task is not None and not task.done():
+            await task
+        await self._flush_pending()
+
+    def _set(self, admins):
+        self._admins = list(admins)
+        permissions = {}
+        for admin in self._admins:
+            permissions.setdefault(admin_key(admin["user_id"]), frozenset(admin["permissions"]))
+        self._permissions = permissions
+        self._pending_usernames = {key for key in permissions if isinstance(key, str)}
+        self._checked_at = time.monotonic()
+
+    def is_pending(self, username):
+        """Есть ли сотрудник, записанный по этому @username и ещё не получивший числовой id."""
+        self._refresh()
+        return admin_key(username) in self._pending_usernames
+
+    def _refresh(self):
+        if self._checked_at is None:
+            self.load()
+            return
+        if time.monotonic() - self._checked_at < self.recheck_interval:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._checked_at = time.monotonic()
+        if self._recheck_task is None or self._recheck_task.done():
+            self._recheck_task = loop.create_task(self._recheck())
+
+    def _writing(self):
+        return self._dirty or (self._flush_task is not None and not self._flush_task.done())
+
+    async def _recheck(self):
+        if self._writing():
+            return
+        try:
+            if await self.backend.fetch_version(self.name) == self._version:
+                return
+            payload, version = await self.backend.fetch(self.name)
+            data = json.loads(payload) if payload is not None else None
+        except (OSError, sqlite3.Error, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка чтения {self.name}: {e}")
+            return
+        if not validate_admins(data):
+            logger.warning(f"Invalid {self.name}, keeping cached admins")
+            return
+        if not self._writing():
+            self._set(data["admins"])
+            self._version = version
+
+    def all(self):
+        self._refresh()
+        return list(self._admins)
+
+    def has_permission(self, user_id, required_permission):
+        self._refresh()
+        permissions = self._permissions.get(admin_key(user_id))
+        if permissions is None:
+            return False
+        return required_permission in permissions or "all" in permissions
+
+admin_registry = AdminRegistry(state)
+usernames = UsernameResolver(state)
+
+# Снимок для холодного старта
+SNAPSHOT_FORMAT = 1
+
+class StateSnapshot:
+    """Каталог и сотрудники в pickle: при старте читаются без разбора и проверки JSON.
+
+    Снимок используется, только если версии документов в хранилище совпадают с записанными
+    в нём, иначе состояние читается как обычно. Файл пишет сам бот; pickle из чужих
+    источников загружать нельзя.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.webhook = None
+
+    def restore(self, catalog, admins):
+        """True, если каталог и сотрудники загружены из снимка."""
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            logger.warning(f"Снимок {self.path} не прочитан: {e}")
+            return False
+        if not isinstance(data, dict) or data.get("format") != SNAPSHOT_FORMAT:
+            return False
+        self.webhook = data.get("webhook")
+        products_version, admins_version = data["products_version"], data["admins_version"]
+        if products_version is None or products_version != catalog.backend.version(catalog.name):
+            return False
+        if admins_version is None or admins_version != admins.backend.version(admins.name):
+            return False
+        catalog.restore(data["products"], products_version)
+        admins.restore(data["admins"], admins_version)
+        return True
+
+    def save(self, catalog, admins):
+        products_state, admins_state = catalog.snapshot_state(), admins.snapshot_state()
+        if products_state is None or admins_state is None:
+            return
+        payload = pickle.dumps({
+            "format": SNAPSHOT_FORMAT,
+            "products": products_state[0],
+            "products_version": products_state[1],
+            "admins": admins_state[0],
+            "admins_version": admins_state[1],
+            "webhook": self.webhook,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            atomic_write(self.path, payload)
+        except OSError as e:
+            logger.error(f"Ошибка записи снимка {self.path}: {e}")
+
+snapshot = StateSnapshot(SNAPSHOT_FILE)
 
 def load_admins():
-    try:
-        with open(ADMINS_FILE, "r") as f:
-            admins = json.load(f)
-            if not validate_admins(admins):
-                print("Invalid admins.json, creating default")
-                admins = [{"user_id": 7652639453, "role": "admin", "permissions": ["all"]}]
-                save_admins(admins)
-            return admins["admins"]
-    except (FileNotFoundError, json.JSONDecodeError):
-        admins = [{"user_id": 7652639453, "role": "admin", "permissions": ["all"]}]
-        save_admins(admins)
-        return admins
+    return admin_registry.all()
+
+def save_admins(admins):
+    admin_registry.save(usernames.rewrite(admins))
+
+def notification_chat_ids():
+    # Сотрудники, для которых id ещё не известен, пропускаются: по @username бот писать не может
+    return [key for key in (admin_key(a["user_id"]) for a in load_admins()) if isinstance(key, int)]
+
+async def learn_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Первая группа хендлеров: запоминает username отправителя и дописывает id сотрудникам."""
+    user = update.effective_user
+    if user is None or not user.username:
+        return
+    usernames.learn(user.username, user.id)
+    if admin_registry.is_pending(user.username):
+        save_admins(load_admins())
+
+# Хранилище заказов (SQLite в режиме WAL)
+ORDER_STATUSES = {"new": "Новый", "processing": "В обработке", "sold": "Продан"}
+OPEN_ORDER_STATUSES = ("new", "processing")
+
+ORDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    message_id INTEGER,
+    buyer_id INTEGER NOT NULL,
+    product_id TEXT,
+    product_name TEXT NOT NULL,
+    product_price REAL,
+    username TEXT,
+    status TEXT NOT NULL DEFAULT 'new',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_buyer ON orders (buyer_id);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, id);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    coalesce_key TEXT UNIQUE,
+    chat_id NOT NULL,
+    message_id INTEGER,
+    text TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at);
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_products (
+    product_id TEXT PRIMARY KEY,
+    product_name TEXT,
+    orders INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_stats_products_revenue ON stats_products (revenue);
+CREATE TABLE IF NOT EXISTS stats_days (
+    day TEXT PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_sold_seconds (
+    bucket INTEGER PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0
+);
+"""
+# Время до продажи копится в логарифмических корзинах: граница каждой следующей в SOLD_BUCKET_BASE раз больше
+SOLD_BUCKET_BASE = 2 ** 0.25
+
+def sold_bucket(seconds):
+    return int(math.log(seconds, SOLD_BUCKET_BASE)) if seconds >= 1 else 0
+
+def histogram_percentile(buckets, fraction):
+    """Верхняя граница корзины, в которую попадает перцентиль; buckets — [(корзина, число)] по возрастанию."""
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen >= rank:
+            return SOLD_BUCKET_BASE ** (bucket + 1)
+    return SOLD_BUCKET_BASE ** (buckets[-1][0] + 1)
+
+def stats_day(timestamp):
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+# Пока сообщение из outbox отправляется, другие процессы его не берут; после сбоя оно вернётся в очередь
+OUTBOX_LEASE = 60
+
+class OrderStore(SQLiteDatabase):
+    """Заказы в SQLite."""
+
+    schema = ORDERS_SCHEMA
+
+    def _create(self, order_id, fields, messages):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(order_id, fields, now)
+            self._count_created(fields.get("product_id"), fields["product_name"], fields.get("status", "new"), now)
+            self._enqueue(messages)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _insert(self, order_id, fields, now):
+        self._db().execute(
+            "INSERT INTO orders (id, message_id, buyer_id, product_id, product_name, "
+            "product_price, username, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                order_id,
+                fields.get("message_id"),
+                fields["buyer_id"],
+                fields.get("product_id"),
+                fields["product_name"],
+                fields.get("product_price"),
+                fields.get("username"),
+                fields.get("status", "new"),
+                now,
+                now,
+            ),
+        )
+
+    def _get(self, order_id):
+        row = self._db().execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone()
+        return dict(row) if row else None
+
+    # Агрегаты для /stats обновляются в тех же транзакциях, что и заказы
+    def _add_counter(self, name, value):
+        self._db().execute(
+            "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+    def _count_created(self, product_id, product_name, status, created_at):
+        db = self._db()
+        self._add_counter(f"orders:{status}", 1)
+        db.execute(
+            "INSERT INTO stats_products (product_id, product_name, orders) VALUES (?, ?, 1) "
+            "ON CONFLICT (product_id) DO UPDATE SET product_name = excluded.product_name, orders = orders + 1",
+            (product_id or "", product_name),
+        )
+        db.execute(
+            "INSERT INTO stats_days (day, orders) VALUES (?, 1) ON CONFLICT (day) DO UPDATE SET orders = orders + 1",
+            (stats_day(created_at),),
+        )
+
+    def _count_sold(self, order, sold_at, sign):
+        """Учитывает продажу (sign=1) или её отмену (sign=-1), если заказ вернули из «Продан»."""
+        db = self._db()
+        price = float(order["product_price"] or 0)
+        self._add_counter("revenue", sign * price)
+        db.execute(
+            "UPDATE stats_products SET sold = sold + ?, revenue = revenue + ? WHERE product_id = ?",
+            (sign, sign * price, order["product_id"] or ""),
+        )
+        db.execute(
+            "INSERT INTO stats_days (day, sold, revenue) VALUES (?, ?, ?) "
+            "ON CONFLICT (day) DO UPDATE SET sold = sold + excluded.sold, revenue = revenue + excluded.revenue",
+            (stats_day(sold_at), sign, sign * price),
+        )
+        db.execute(
+            "INSERT INTO stats_sold_seconds (bucket, orders) VALUES (?, ?) "
+            "ON CONFLICT (bucket) DO UPDATE SET orders = orders + excluded.orders",
+            (sold_bucket(sold_at - order["created_at"]), sign),
+        )
+
+    def _count_status_change(self, order, previous_status, previous_updated_at):
+        if previous_status == order["status"]:
+            return
+        self._add_counter(f"orders:{previous_status}", -1)
+        self._add_counter(f"orders:{order['status']}", 1)
+        if previous_status == "sold":
+            self._count_sold(order, previous_updated_at, -1)
+        if order["status"] == "sold":
+            self._count_sold(order, order["updated_at"], 1)
+
+    def _migrate(self, conn):
+        # Агрегаты появились позже заказов: один раз пересчитываем их по существующей истории
+        if conn.execute("SELECT 1 FROM stats_counters LIMIT 1").fetchone() is not None:
+            return
+        if conn.execute("SELECT 1 FROM orders LIMIT 1").fetchone() is None:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in conn.execute("SELECT * FROM orders ORDER BY id").fetchall():
+                order = dict(row)
+                self._count_created(order["product_id"], order["product_name"], order["status"], order["created_at"])
+                if order["status"] == "sold":
+                    self._count_sold(order, order["updated_at"], 1)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _set_status(self, order_id, status, effects):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            order = self._get(order_id)
+            # Повторное нажатие той же кнопки ничего не меняет и не шлёт клиенту второе сообщение
+            if order is not None and order["status"] != status:
+                order["previous_status"] = order["status"]
+                previous_updated_at = order["updated_at"]
+                order["status"] = status
+                order["updated_at"] = time.time()
+                db.execute(
+                    "UPDATE orders SET status = ?, updated_at = ? WHERE id = ?",
+                    (status, order["updated_at"], order_id),
+                )
+                self._count_status_change(order, order["previous_status"], previous_updated_at)
+                if effects is not None:
+                    self._enqueue(effects(order))
+            elif order is not None:
+                order["previous_status"] = status
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return order
+
+    def _reserve_ids(self, name, count):
+        db = self._db()
+        # BEGIN IMMEDIATE берёт блокировку записи, поэтому блоки не пересекаются и между процессами
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                value = db.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+                db.execute("INSERT INTO sequences (name, value) VALUES (?, ?)", (name, value + count))
+            else:
+                value = row[0]
+                db.execute("UPDATE sequences SET value = ? WHERE name = ?", (value + count, name))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return value + 1
+
+    def _open_orders(self, limit):
+        placeholders = ", ".join("?" for _ in OPEN_ORDER_STATUSES)
+        rows = self._db().execute(
+            f"SELECT * FROM orders WHERE status IN ({placeholders}) ORDER BY id LIMIT ?",
+            (*OPEN_ORDER_STATUSES, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _enqueue(self, messages):
+        # Правка с тем же coalesce_key заменяет ещё не отправленную: уйдёт только последний текст
+        now = time.time()
+        for message in messages:
+            self._db().execute(
+                "INSERT INTO outbox (kind, coalesce_key, chat_id, message_id, text, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (coalesce_key) DO UPDATE SET text = excluded.text, message_id = excluded.message_id, "
+                "version = version + 1, attempts = 0, next_attempt_at = excluded.next_attempt_at",
+                (
+                    message["kind"],
+                    message.get("coalesce_key"),
+                    message["chat_id"],
+                    message.get("message_id"),
+                    message["text"],
+                    now,
+                    now,
+                ),
+            )
+
+    def _claim_outbox(self, limit):
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                "SELECT * FROM outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?", (now, limit)
+            ).fetchall()
+            db.executemany(
+                "UPDATE outbox SET next_attempt_at = ? WHERE id = ?", [(now + OUTBOX_LEASE, row["id"]) for row in rows]
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return [dict(row) for row in rows]
+
+    def _finish_outbox(self, message_id, version):
+        # Если текст успели заменить, version уже другая и новая правка остаётся в очереди
+        self._db().execute("DELETE FROM outbox WHERE id = ? AND version = ?", (message_id, version))
+
+    def _finish_order_post(self, message_id, version, order_id, posted_message_id):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("UPDATE orders SET message_id = ? WHERE id = ?", (posted_message_id, order_id))
+            db.execute("DELETE FROM outbox WHERE id = ? AND version = ?", (message_id, version))
+            # Статус сменился, пока пост отправлялся: новый текст уходит правкой уже опубликованного поста
+            db.execute(
+                "UPDATE outbox SET kind = 'edit', message_id = ? WHERE id = ?", (posted_message_id, message_id)
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _retry_outbox(self, message_id, version, attempts, next_attempt_at):
+        self._db().execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ? AND version = ?",
+            (attempts, next_attempt_at, message_id, version),
+        )
+
+    def _next_outbox_at(self):
+        return self._db().execute("SELECT MIN(next_attempt_at) FROM outbox").fetchone()[0]
+
+    def _stats(self, days, top):
+        db = self._db()
+        counters = {row["name"]: row["value"] for row in db.execute("SELECT name, value FROM stats_counters")}
+        return {
+            "orders": {status: int(counters.get(f"orders:{status}", 0)) for status in ORDER_STATUSES},
+            "revenue": counters.get("revenue", 0.0),
+            "days": [dict(row) for row in db.execute("SELECT * FROM stats_days ORDER BY day DESC LIMIT ?", (days,))],
+            "top_products": [
+                dict(row)
+                for row in db.execute("SELECT * FROM stats_products WHERE sold > 0 ORDER BY revenue DESC LIMIT ?", (top,))
+            ],
+            "sold_seconds": [
+                (row["bucket"], row["orders"])
+                for row in db.execute("SELECT bucket, orders FROM stats_sold_seconds WHERE orders > 0 ORDER BY bucket")
+            ],
+        }
+
+    def _by_buyer(self, buyer_id, limit):
+        rows = self._db().execute(
+            "SELECT * FROM orders WHERE buyer_id = ? ORDER BY id DESC LIMIT ?", (buyer_id, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    async def create(self, order_id, messages=(), **fields):
+        """Записывает заказ; messages для outbox записываются в той же транзакции."""
+        await self._run(self._create, order_id, fields, messages)
+
+    async def get(self, order_id):
+        return await self._run(self._get, order_id)
+
+    async def set_status(self, order_id, status, effects=None):
+        """Меняет статус заказа; возвращает заказ (с previous_status) или None.
+
+        effects(order) возвращает сообщения для outbox — они записываются в той же транзакции.
+        """
+        return await self._run(self._set_status, order_id, status, effects)
+
+    async def enqueue(self, messages):
+        await self._run(self._enqueue, messages)
+
+    async def claim_outbox(self, limit):
+        """Сообщения, которые пора отправить; на время отправки они скрыты от других процессов."""
+        return await self._run(self._claim_outbox, limit)
+
+    async def finish_outbox(self, message_id, version):
+        await self._run(self._finish_outbox, message_id, version)
+
+    async def finish_order_post(self, message_id, version, order_id, posted_message_id):
+        """Удаляет доставленный пост заказа из outbox и запоминает его message_id в заказе."""
+        await self._run(self._finish_order_post, message_id, version, order_id, posted_message_id)
+
+    async def retry_outbox(self, message_id, version, attempts, next_attempt_at):
+        await self._run(self._retry_outbox, message_id, version, attempts, next_attempt_at)
+
+    async def next_outbox_at(self):
+        return await self._run(self._next_outbox_at)
+
+    async def reserve_ids(self, name, count):
+        """Резервирует count номеров последовательности name; возвращает первый из них."""
+        return await self._run(self._reserve_ids, name, count)
+
+    async def open_orders(self, limit=50):
+        return await self._run(self._open_orders, limit)
+
+    async def stats(self, days=7, top=5):
+        """Сводка продаж из агрегатов: стоимость не зависит от числа заказов."""
+        return await self._run(self._stats, days, top)
+
+    async def by_buyer(self, buyer_id, limit=20):
+        return await self._run(self._by_buyer, buyer_id, limit)
+
+order_store = OrderStore(ORDERS_DB)
+
+# Номера заказов
+ORDER_ID_BLOCK_SIZE = 50
+
+class OrderIdAllocator:
+    """Выдаёт номера заказов из блоков, заранее зарезервированных в БД.
+
+    Внутри блока номер выдаётся без обращения к диску и без блокировок: между await
+    в asyncio ничего не переключается. Запись в БД — одна на block_size заказов.
+    """
+
+    def __init__(self, store, name="orders", block_size=ORDER_ID_BLOCK_SIZE):
+        self.store = store
+        self.name = name
+        self.block_size = block_size
+        self._next = 0
+        self._limit = 0
+        self._refill = None
+
+    async def next_id(self):
+        while self._next >= self._limit:
+            if self._refill is None:
+                self._refill = asyncio.get_running_loop().create_task(self._reserve())
+            await asyncio.shield(self._refill)
+        order_id = self._next
+        self._next += 1
+        return order_id
+
+    async def _reserve(self):
+        try:
+            start = await self.store.reserve_ids(self.name, self.block_size)
+            self._next, self._limit = start, start + self.block_size
+        finally:
+            self._refill = None
+
+order_ids = OrderIdAllocator(order_store)
+
+# Запросы к Bot API
+REQUEST_POOL_TIMEOUT = 10.0
+REQUEST_KEEPALIVE_EXPIRY = 60.0
+MEDIA_METHODS = {
+    "sendPhoto", "sendDocument", "sendVideo", "sendAudio", "sendAnimation", "sendVoice",
+    "sendMediaGroup", "editMessageMedia", "getFile",
+}
+# (read, write) таймауты по методам; остальные — по умолчанию пула
+METHOD_TIMEOUTS = {
+    "sendPhoto": (20.0, 30.0),
+    "sendDocument": (30.0, 60.0),
+    "editMessageMedia": (20.0, 30.0),
+    "sendMessage": (10.0, 5.0),
+    "editMessageText": (10.0, 5.0),
+    "answerCallbackQuery": (5.0, 5.0),
+}
+
+_ssl_context = None
+
+def shared_ssl_context():
+    # Загрузка корневых сертификатов — самая дорогая часть создания клиента; делаем её один раз на все пулы
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+class PooledRequest(HTTPXRequest):
+    """HTTPXRequest с ограничением одновременных запросов размером пула, замером ожидания и таймаутами по методам.
+
+    Свободное соединение ждём сами (с таймаутом pool_timeout), поэтому пул httpx
+    никогда не переполняется, а время ожидания попадает в bot_api_pool_wait_seconds.
+    """
+
+    def __init__(self, name, pool_size, pool_timeout=REQUEST_POOL_TIMEOUT, keepalive_expiry=REQUEST_KEEPALIVE_EXPIRY, **kwargs):
+        self.name = name
+        self._keepalive_expiry = keepalive_expiry
+        self._slots = asyncio.Semaphore(pool_size)
+        self._slot_timeout = pool_timeout
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout, **kwargs)
+
+    def _build_client(self):
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        self._client_kwargs["verify"] = shared_ssl_context()
+        return super()._build_client()
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        method_name = api_method(url)
+        timeouts = METHOD_TIMEOUTS.get(method_name)
+        if timeouts is not None:
+            if read_timeout is BaseRequest.DEFAULT_NONE:
+                read_timeout = timeouts[0]
+            if write_timeout is BaseRequest.DEFAULT_NONE:
+                write_timeout = timeouts[1]
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._slot_timeout)
+        except asyncio.TimeoutError:
+            API_POOL_TIMEOUTS.labels(self.name).inc()
+            raise TimedOut(f"Пул соединений {self.name} занят дольше {self._slot_timeout} с")
+        try:
+            API_POOL_WAIT_SECONDS.labels(self.name).observe(time.monotonic() - started)
+            with API_REQUEST_SECONDS.labels(method_name, self.name).time():
+                return await super().do_request(
+                    url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+                )
+        finally:
+            self._slots.release()
+
+def api_method(url):
+    """Имя метода Bot API из URL запроса (для скачивания файла — 'file')."""
+    if "/file/bot" in url:
+        return "file"
+    return url.rsplit("/", 1)[-1]
+
+class RoutingRequest(BaseRequest):
+    """Разводит запросы по двум пулам: медиа и файлы отдельно, чтобы загрузки не занимали соединения сообщений."""
+
+    def __init__(self, pool_size=REQUEST_POOL_SIZE, media_pool_size=MEDIA_POOL_SIZE, http_version=REQUEST_HTTP_VERSION):
+        self.messages = PooledRequest("messages", pool_size, http_version=http_version, read_timeout=10.0, write_timeout=10.0)
+        self.media = PooledRequest("media", media_pool_size, http_version=http_version, read_timeout=20.0, write_timeout=30.0, media_write_timeout=60.0)
+
+    @property
+    def read_timeout(self):
+        return self.messages.read_timeout
+
+    def pools(self):
+        return [self.messages, self.media]
+
+    async def initialize(self):
+        for pool in self.pools():
+            await pool.initialize()
+
+    async def shutdown(self):
+        for pool in self.pools():
+            await pool.shutdown()
+
+    async def prewarm(self, url):
+        """Открывает соединения обоих пулов заранее, чтобы первый запрос не ждал TCP и TLS."""
+        results = await asyncio.gather(*(pool.post(url) for pool in self.pools()), return_exceptions=True)
+        for pool, result in zip(self.pools(), results):
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось прогреть пул {pool.name}: {result}")
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        name = api_method(url)
+        is_media = name == "file" or name in MEDIA_METHODS or (request_data is not None and request_data.contains_files)
+        pool = self.media if is_media else self.messages
+        return await pool.do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу или канал
+GLOBAL_SEND_RATE = 30
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+SEND_CONCURRENCY = 8
+SEND_RETRIES = 3
+
+class TokenBucket:
+    """Ведро токенов: acquire() ждёт ровно столько, сколько нужно до появления токена."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        # Токен резервируется сразу, поэтому ожидающие выстраиваются в очередь без гонок
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def pause(self, seconds):
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+def is_group_chat(chat_id):
+    if isinstance(chat_id, int):
+        return chat_id < 0
+    return str(chat_id).startswith("@")
+
+class TelegramRateLimiter:
+    """Пропускает запросы к Bot API через глобальный лимит и лимит на чат, повторяет при RetryAfter."""
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, concurrency=SEND_CONCURRENCY, max_chats=10000):
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = OrderedDict()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.max_chats = max_chats
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(GROUP_CHAT_RATE, capacity=GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id, make_request, retries=SEND_RETRIES):
+        """Выполняет make_request() (фабрику корутины) с учётом лимитов для chat_id."""
+        attempt = 0
+        while True:
+            bucket = self._chat_bucket(chat_id)
+            await bucket.acquire()
+            await self._global.acquire()
+            async with self._semaphore:
+                try:
+                    return await make_request()
+                except RetryAfter as e:
+                    FLOOD_WAITS.inc()
+                    FLOOD_WAIT_SECONDS.inc(e.retry_after)
+                    # Пауза ведра задержит и этот повтор, и другие запросы в тот же чат
+                    bucket.pause(e.retry_after)
+                    if attempt >= retries:
+                        raise
+                    delay = 0
+                except BadRequest:
+                    raise
+                except (TimedOut, NetworkError) as e:
+                    if attempt >= retries:
+                        raise
+                    API_RETRIES.labels("timeout" if isinstance(e, TimedOut) else "network").inc()
+                    delay = 0.5 * 2 ** attempt
+            attempt += 1
+            if delay:
+                await asyncio.sleep(delay)
+
+rate_limiter = TelegramRateLimiter()
+
+class NotificationDispatcher:
+    """Фоновая рассылка одного сообщения нескольким получателям."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def fan_out(self, application: Application, chat_ids, text, **kwargs):
+        return application.create_task(self._fan_out(application.bot, list(chat_ids), text, kwargs))
+
+    async def _fan_out(self, bot, chat_ids, text, kwargs):
+        results = await asyncio.gather(
+            *(
+                self.limiter.call(chat_id, lambda chat_id=chat_id: bot.send_message(chat_id=chat_id, text=text, **kwargs))
+                for chat_id in chat_ids
+            ),
+            return_exceptions=True,
+        )
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка отправки уведомления {chat_id}: {result}")
+
+notifications = NotificationDispatcher(rate_limiter)
+
+# Outbox: пост заказа в канале и побочные эффекты смены статуса доставляются в фоне, с повторами
+OUTBOX_BATCH_SIZE = 20
+ORDER_POST_KEY_PREFIX = "order:"
+OUTBOX_MAX_ATTEMPTS = 12
+OUTBOX_MAX_BACKOFF = 600
+
+class OutboxWorker:
+    """Отправляет сообщения из таблицы outbox: лимиты Telegram, пауза по RetryAfter, экспоненциальный backoff.
+
+    Сообщение удаляется из outbox только после ответа Telegram, поэтому после
+    перезапуска недоставленное отправляется снова.
+    """
+
+    def __init__(self, store, limiter, batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.store = store
+        self.limiter = limiter
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, bot):
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self, bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                messages = await self.store.claim_outbox(self.batch_size)
+                if messages:
+                    await asyncio.gather(*(self._deliver(bot, message) for message in messages))
+                    continue
+                next_at = await self.store.next_outbox_at()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка чтения outbox: {e}")
+                next_at = time.time() + 5
+            timeout = None if next_at is None else max(0.0, next_at - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send(self, bot, message):
+        if message["kind"] == "edit":
+            return bot.edit_message_text(chat_id=message["chat_id"], message_id=message["message_id"], text=message["text"])
+        return bot.send_message(chat_id=message["chat_id"], text=message["text"])
+
+    async def _deliver(self, bot, message):
+        try:
+            sent = await self.limiter.call(message["chat_id"], lambda: self._send(bot, message), retries=0)
+            if message["kind"] == "order_post":
+                order_id = int(message["coalesce_key"].removeprefix(ORDER_POST_KEY_PREFIX))
+                await self.store.finish_order_post(message["id"], message["version"], order_id, sent.message_id)
+                return
+        except RetryAfter as e:
+            await self._retry(message, e.retry_after, count_attempt=False)
+            return
+        except BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                logger.error(f"Сообщение outbox {message['id']} отклонено: {e}")
+        except Forbidden as e:
+            logger.error(f"Сообщение outbox {message['id']} не доставлено: {e}")
+        except Exception as e:
+            if message["attempts"] + 1 < self.max_attempts:
+                await self._retry(message, min(OUTBOX_MAX_BACKOFF, 2 ** message["attempts"]))
+                return
+            logger.error(f"Сообщение outbox {message['id']} не доставлено после {message['attempts'] + 1} попыток: {e}")
+        await self.store.finish_outbox(message["id"], message["version"])
+
+    async def _retry(self, message, delay, count_attempt=True):
+        attempts = message["attempts"] + 1 if count_attempt else message["attempts"]
+        await self.store.retry_outbox(message["id"], message["version"], attempts, time.time() + delay)
+
+outbox = OutboxWorker(order_store, rate_limiter)
+
+# Журнал изменений каталога и сотрудников
+JOURNAL_MAX_BYTES = 5 * 1024 * 1024
+CHANGE_SUMMARY_DELAY = 3.0
+CHANGE_SUMMARY_MAX_LINES = 20
+EXPORT_DEBOUNCE = 2.0
+
+def describe_change(entry):
+    action = entry["action"]
+    if action == "product_add":
+        return f"+ товар {entry['id']} «{entry['name']}», {entry['price']} руб."
+    if action == "product_delete":
+        return f"− товар {entry['id']} «{entry['name']}»"
+    if action == "catalog_import":
+        return f"каталог загружен: {entry['count']} товаров (удалено {entry.get('removed', 0)})"
+    if action == "admin_add":
+        return f"+ сотрудник {entry['user_id']} ({entry['role']})"
+    if action == "admin_remove":
+        return f"− сотрудник {entry['user_id']}"
+    if action == "admins_import":
+        return f"admins.json загружен: {entry['count']} сотрудников"
+    if action == "bulk_price":
+        return f"цены {entry['change']} ({entry['query'] or 'все товары'}): {entry['count']} товаров"
+    if action == "bulk_delete":
+        return f"− {entry['count']} товаров по запросу «{entry['query']}»"
+    if action == "republish":
+        return f"перепубликация канала: {entry['count']} товаров"
+    return action
+
+class ChangeJournal:
+    """Append-only журнал изменений (JSONL). После правок админ получает одну сводку на серию изменений."""
+
+    def __init__(self, path, summary_delay=CHANGE_SUMMARY_DELAY, max_bytes=JOURNAL_MAX_BYTES):
+        self.path = path
+        self.summary_delay = summary_delay
+        self.max_bytes = max_bytes
+        self._pending = {}
+        self._tasks = {}
+
+    def _append(self, entry):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            size = f.tell()
+        if size > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+
+    def record(self, application: Application, actor_id, action, **details):
+        entry = {"ts": int(time.time()), "actor": actor_id, "action": action, **details}
+        try:
+            self._append(entry)
+        except OSError as e:
+            logger.error(f"Ошибка записи журнала: {e}")
+        self._pending.setdefault(actor_id, []).append(entry)
+        task = self._tasks.get(actor_id)
+        if task is None or task.done():
+            self._tasks[actor_id] = application.create_task(self._send_summary_later(application.bot, actor_id))
+
+    async def _send_summary_later(self, bot, actor_id):
+        await asyncio.sleep(self.summary_delay)
+        entries = self._pending.pop(actor_id, [])
+        if not entries:
+            return
+        lines = [describe_change(entry) for entry in entries[:CHANGE_SUMMARY_MAX_LINES]]
+        if len(entries) > len(lines):
+            lines.append(f"... и ещё {len(entries) - len(lines)}")
+        text = "Изменения:\n" + "\n".join(lines) + "\n\nПолная выгрузка: /export"
+        try:
+            await bot.send_message(chat_id=actor_id, text=text)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки изменений: {e}")
+
+journal = ChangeJournal(JOURNAL_FILE)
+
+# Выгрузка /export: zip с products.json и admins.json
+def zip_documents(documents):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for file_name, payload in documents:
+            archive.writestr(file_name, payload)
+    return buffer.getvalue()
+
+async def build_snapshot_archive():
+    documents = []
+    for name, file_name in [("products", PRODUCTS_FILE), ("admins", ADMINS_FILE)]:
+        payload, _ = await state.fetch(name)
+        if payload is not None:
+            documents.append((file_name, payload))
+    return await asyncio.to_thread(zip_documents, documents)
+
+class SnapshotExporter:
+    """Отправляет архив после паузы в запросах: серия /export даёт одну загрузку."""
+
+    def __init__(self, delay=EXPORT_DEBOUNCE):
+        self.delay = delay
+        self._requested = {}
+        self._tasks = {}
+
+    def request(self, application: Application, chat_id):
+        self._requested[chat_id] = time.monotonic()
+        task = self._tasks.get(chat_id)
+        if task is None or task.done():
+            self._tasks[chat_id] = application.create_task(self._export_later(application.bot, chat_id))
+
+    async def _export_later(self, bot, chat_id):
+        while True:
+            wait = self._requested[chat_id] + self.delay - time.monotonic()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        del self._requested[chat_id]
+        await catalog.flush()
+        await admin_registry.flush()
+        try:
+            archive = await build_snapshot_archive()
+            await bot.send_document(
+                chat_id=chat_id,
+                document=archive,
+                filename=time.strftime("shop_export_%Y%m%d_%H%M%S.zip")
+            )
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки: {e}")
+
+exporter = SnapshotExporter()
+
+# Карточка товара: подпись и кнопка «Заказать»
+RENDER_CACHE_SIZE = 2048
+
+def product_caption(name, price, description):
+    return (
+        f"<b>Название:</b> {html.escape(str(name))}\n"
+        f"<b>Цена:</b> {html.escape(str(price))} руб.\n"
+        f"<b>Описание:</b> {html.escape(str(description))}"
+    )
+
+class ProductCardCache:
+    """Готовые подписи и клавиатуры товаров по ключу (id, версия в каталоге)."""
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._cards = OrderedDict()
+
+    def render(self, product):
+        version = catalog.version(product["id"]) if catalog.get(product["id"]) is product else None
+        if version is None:
+            # Товар ещё не в каталоге (черновик) — кэшировать нечего
+            return self._build(product)
+        cached = self._cards.get(product["id"])
+        if cached is not None and cached[0] == version:
+            self._cards.move_to_end(product["id"])
+            return cached[1]
+        card = self._build(product)
+        self._cards[product["id"]] = (version, card)
+        self._cards.move_to_end(product["id"])
+        if len(self._cards) > self.max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    def _build(self, product):
+        text = product_caption(product["name"], product["price"], product["description"])
+        keyboard = [[InlineKeyboardButton("Заказать", callback_data=pack_callback(CB_ORDER, product["id"]))]]
+        return text, InlineKeyboardMarkup(keyboard)
+
+    def invalidate(self, product_id=None):
+        if product_id is None:
+            self._cards.clear()
+        else:
+            self._cards.pop(product_id, None)
+
+product_cards = ProductCardCache()
+
+def render_product_card(product):
+    return product_cards.render(product)
+
+# Синхронизация каталога с каналом
+SYNC_WORKERS = 4
+
+def product_fingerprint(product):
+    """Короткий хэш того, что видно в посте товара: по нему понятно, изменился ли пост."""
+    raw = json.dumps([product.get("name"), str(product.get("price")), product.get("description"), product.get("photo_id")])
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+class ChannelSync:
+    """Публикует новые товары и правит изменённые посты в канале, сохраняя message_id по мере ответа Telegram."""
+
+    def __init__(self, limiter, workers=SYNC_WORKERS):
+        self.limiter = limiter
+        self.workers = workers
+
+    def plan(self, products, previous):
+        """Сравнивает каталог с предыдущей версией: (задачи, число неизменённых товаров)."""
+        jobs = []
+        unchanged = 0
+        for product in products:
+            old = previous.get(product["id"])
+            message_id = product.get("message_id") or (old or {}).get("message_id")
+            fingerprint = product_fingerprint(product)
+            if not message_id:
+                jobs.append(("post", product, None, None))
+                continue
+            posted = product.get("sync_hash")
+            if posted is None and old is not None and old.get("message_id") == message_id:
+                posted = old.get("sync_hash") or product_fingerprint(old)
+            if posted == fingerprint:
+                unchanged += 1
+                if product.get("message_id") != message_id or product.get("sync_hash") != fingerprint:
+                    catalog.update(product["id"], message_id=message_id, sync_hash=fingerprint)
+                continue
+            old_photo = (old if old is not None else product).get("photo_id")
+            jobs.append(("edit", product, message_id, old_photo))
+        return jobs, unchanged
+
+    async def run(self, bot, products, previous=None, deleted=(), progress=None):
+        """deleted — message_id постов удалённых товаров; progress(готово, всего) вызывается после каждой задачи."""
+        jobs, unchanged = self.plan(products, previous or {})
+        jobs += [("delete", None, message_id, None) for message_id in deleted]
+        stats = {"posted": 0, "edited": 0, "deleted": 0, "unchanged": unchanged, "failed": 0}
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        done = 0
+
+        async def worker():
+            nonlocal done
+            while not queue.empty():
+                action, product, message_id, old_photo = queue.get_nowait()
+                try:
+                    if action == "post":
+                        await self._post(bot, product)
+                        stats["posted"] += 1
+                    elif action == "delete":
+                        await self._delete(bot, message_id)
+                        stats["deleted"] += 1
+                    else:
+                        await self._edit(bot, product, message_id, old_photo)
+                        stats["edited"] += 1
+                except Exception as e:
+                    stats["failed"] += 1
+                    target = f"товара {product['id']}" if product is not None else f"поста {message_id}"
+                    logger.error(f"Ошибка синхронизации {target}: {e}")
+                done += 1
+                if progress is not None:
+                    await progress(done, len(jobs))
+
+        # Упавший обработчик не прерывает остальных: его задачи разберут другие, ошибка попадёт в лог.
+        # Отмена run() (остановка бота) отменяет все обработчики вместе с ним
+        results = await asyncio.gather(*(worker() for _ in range(min(self.workers, len(jobs)))), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Ошибка обработчика синхронизации канала", exc_info=result)
+        return stats
+
+    async def _post(self, bot, product):
+        text, reply_markup = render_product_card(product)
+        if product.get("photo_id"):
+            message = await self.limiter.call(PRODUCTS_CHANNEL, lambda: bot.send_photo(
+                chat_id=PRODUCTS_CHANNEL,
+                photo=product["photo_id"],
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            ))
+        else:
+            message = await self.limiter.call(PRODUCTS_CHANNEL, lambda: bot.send_message(
+                chat_id=PRODUCTS_CHANNEL,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            ))
+        # Сохраняем сразу: при сбое посередине повтор не опубликует товар второй раз
+        catalog.update(product["id"], message_id=message.message_id, sync_hash=product_fingerprint(product))
 
-def save_admins(admins):
-    with open(ADMINS_FILE, "w") as f:
-        json.dump({"admins": admins}, f, indent=2)
+    async def _edit(self, bot, product, message_id, old_photo):
+        photo_id = product.get("photo_id")
+        if bool(photo_id) != bool(old_photo):
+            # Пост с фото нельзя превратить в текстовый и наоборот — публикуем заново
+            await self._delete(bot, message_id)
+            await self._post(bot, product)
+            return
+        text, reply_markup = render_product_card(product)
+        if photo_id and photo_id != old_photo:
+            request = lambda: bot.edit_message_media(
+                chat_id=PRODUCTS_CHANNEL,
+                message_id=message_id,
+                media=InputMediaPhoto(media=photo_id, caption=text, parse_mode="HTML"),
+                reply_markup=reply_markup
+            )
+        elif photo_id:
+            request = lambda: bot.edit_message_caption(
+                chat_id=PRODUCTS_CHANNEL,
+                message_id=message_id,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            )
+        else:
+            request = lambda: bot.edit_message_text(
+                chat_id=PRODUCTS_CHANNEL,
+                message_id=message_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            )
+        try:
+            await self.limiter.call(PRODUCTS_CHANNEL, request)
+        except BadRequest as e:
+            if "not modified" in e.message:
+                pass
+            elif "not found" in e.message:
+                await self._post(bot, product)
+                return
+            else:
+                raise
+        catalog.update(product["id"], message_id=message_id, sync_hash=product_fingerprint(product))
 
-async def send_json_files(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    for file_path in [PRODUCTS_FILE, ADMINS_FILE]:
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=f,
-                    filename=os.path.basename(file_path)
-                )
+    async def _delete(self, bot, message_id):
+        try:
+            await self.limiter.call(PRODUCTS_CHANNEL, lambda: bot.delete_message(chat_id=PRODUCTS_CHANNEL, message_id=message_id))
+        except Exception as e:
+            logger.error(f"Ошибка удаления сообщения: {e}")
 
-async def sync_products_with_channel(context: ContextTypes.DEFAULT_TYPE):
-    products = load_products()
-    for product in products:
-        if "message_id" not in product or not product["message_id"]:
-            text = f"<b>Название:</b> {product['name']}\n<b>Цена:</b> {product['price']} руб.\n<b>Описание:</b> {product['description']}"
-            keyboard = [[InlineKeyboardButton("Заказать", callback_data=f"order_{product['id']}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            if product.get("photo_id"):
-                message = await context.bot.send_photo(
-                    chat_id=PRODUCTS_CHANNEL,
-                    photo=product["photo_id"],
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-            else:
-                message = await context.bot.send_message(
-                    chat_id=PRODUCTS_CHANNEL,
-                    text=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-            product["message_id"] = message.message_id
-    save_products(products)
+channel_sync = ChannelSync(rate_limiter)
 
 # Проверка прав
 def check_permission(user_id, required_permission):
-    admins = load_admins()
-    for admin in admins:
-        if admin["user_id"] == user_id:
-            return required_permission in admin["permissions"] or "all" in admin["permissions"]
-    return False
+    return admin_registry.has_permission(user_id, required_permission)
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
-        [InlineKeyboardButton("Заказ", callback_data="role_order")],
-        [InlineKeyboardButton("Админ", callback_data="role_admin")]
+        [InlineKeyboardButton("Заказ", callback_data=CB_ROLE_ORDER)],
+        [InlineKeyboardButton("Админ", callback_data=CB_ROLE_ADMIN)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Добро пожаловать! Выберите роль:", reply_markup=reply_markup)
 
 # Команда /upload_json
+PRODUCTS_UPLOAD_NAMES = ["products.json", "products.ndjson", "products.jsonl"]
+
 async def upload_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not check_permission(user_id, "all"):
@@ -166,22 +2641,21 @@ async def upload_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     file = await update.message.document.get_file()
     file_name = update.message.document.file_name
-    if file_name not in ["products.json", "admins.json"]:
-        await update.message.reply_text("Неверный файл! Отправьте products.json или admins.json.")
+    if file_name not in PRODUCTS_UPLOAD_NAMES + ["admins.json"]:
+        await update.message.reply_text("Неверный файл! Отправьте products.json (или products.ndjson) или admins.json.")
         return
-    file_path = f"temp_{file_name}"
+    fd, file_path = tempfile.mkstemp(prefix="temp_", suffix="_" + file_name)
+    os.close(fd)
     await file.download_to_drive(file_path)
     try:
+        if file_name in PRODUCTS_UPLOAD_NAMES:
+            await import_products_file(update, context, file_path, ndjson=file_name.endswith(NDJSON_EXTENSIONS))
+            return
         with open(file_path, "r") as f:
             data = json.load(f)
-        if file_name == "products.json" and validate_products(data):
-            save_products(data)
-            await sync_products_with_channel(context)
-            await send_json_files(update, context, user_id)
-            await update.message.reply_text("products.json загружен и синхронизирован!")
-        elif file_name == "admins.json" and validate_admins(data):
+        if validate_admins(data):
             save_admins(data["admins"])
-            await send_json_files(update, context, user_id)
+            journal.record(context.application, user_id, "admins_import", count=len(data["admins"]))
             await update.message.reply_text("admins.json загружен!")
         else:
             await update.message.reply_text("Некорректная структура JSON!")
@@ -191,245 +2665,723 @@ async def upload_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if os.path.exists(file_path):
             os.remove(file_path)
 
+async def import_products_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path, ndjson=False):
+    # Разбор и проверка — в отдельном потоке; каталог подменяется целиком, только если ошибок нет
+    products, errors, error_count = await asyncio.to_thread(import_products, file_path, ndjson)
+    if error_count:
+        text = f"Некорректные товары ({error_count}), каталог не изменён:\n" + "\n".join(errors)
+        if error_count > len(errors):
+            text += f"\n... и ещё {error_count - len(errors)}"
+        await update.message.reply_text(text)
+        return
+    previous = {p["id"]: dict(p) for p in catalog.all()}
+    catalog.replace(products)
+    kept = {p["id"] for p in products}
+    # Посты товаров, которых нет в новом файле, удаляются из канала
+    deleted = [p["message_id"] for product_id, p in previous.items() if product_id not in kept and p.get("message_id")]
+    journal.record(
+        context.application, update.effective_user.id, "catalog_import",
+        count=len(products), removed=len(previous) - len(kept & previous.keys())
+    )
+    await update.message.reply_text(f"Каталог загружен ({len(products)} товаров)!")
+    await start_channel_job(update, context, "Синхронизация канала", products=catalog.all(), previous=previous, deleted=deleted)
+
+# Смена статуса заказа
+def order_channel_message(order):
+    """Пост заказа в канале для outbox: публикация, пока message_id не известен, иначе правка.
+
+    Ключ у публикации и правок общий, поэтому смена статуса до публикации просто меняет текст поста.
+    """
+    order_text = f"Заказ #{order['id']} | Товар: {order['product_name']} | Клиент: @{order['username']} | Статус: {ORDER_STATUSES[order['status']]}"
+    return {
+        "kind": "edit" if order["message_id"] else "order_post",
+        "coalesce_key": f"{ORDER_POST_KEY_PREFIX}{order['id']}",
+        "chat_id": ORDERS_CHANNEL,
+        "message_id": order["message_id"],
+        "text": order_text,
+    }
+
+def order_status_effects(order, buyer_text):
+    """Сообщения outbox при смене статуса: пост заказа в канале и уведомление клиента."""
+    return [order_channel_message(order), {"kind": "send", "chat_id": order["buyer_id"], "text": buyer_text}]
+
+async def change_order_status(query, context: ContextTypes.DEFAULT_TYPE, order_id, status, buyer_text, reply_text):
+    # Правка канала и уведомление клиента уходят через outbox, админ получает ответ сразу
+    order_info = await order_store.set_status(order_id, status, lambda order: order_status_effects(order, buyer_text))
+    if order_info is None:
+        await query.message.reply_text("Заказ не найден!")
+        return
+    if order_info["previous_status"] == status:
+        await query.message.reply_text(f"Заказ #{order_id} уже в статусе «{ORDER_STATUSES[status]}»")
+        return
+    outbox.wake()
+    await query.message.reply_text(reply_text)
+
+# Массовые операции: /price, /delete_products, /republish
+PROGRESS_INTERVAL = 3
+BULK_DELETE_PREVIEW = 10
+PRICE_CHANGE_RE = re.compile(r"^([+=-]?)(\d+(?:[.,]\d+)?)(%?)$")
+
+def parse_price_change(text):
+    """'+10%', '-5%', '+100', '-50', '=990' → функция новой цены или None."""
+    match = PRICE_CHANGE_RE.match(text.strip())
+    if match is None:
+        return None
+    sign, number, percent = match.groups()
+    value = float(number.replace(",", "."))
+    if percent:
+        if sign == "=":
+            return None
+        factor = 1 + (value if sign != "-" else -value) / 100
+        return lambda price: price * factor
+    if sign in ("", "="):
+        return lambda price: value
+    delta = value if sign == "+" else -value
+    return lambda price: price + delta
+
+def format_price(price):
+    price = round(price, 2)
+    return int(price) if price == int(price) else price
+
+def matching_products(query):
+    products, _ = catalog.search(query, limit=len(catalog))
+    return products
+
+class ProgressReporter:
+    """Показывает прогресс долгой операции, правя одно сообщение не чаще раза в interval секунд."""
+
+    def __init__(self, message, title, interval=PROGRESS_INTERVAL):
+        self.message = message
+        self.title = title
+        self.interval = interval
+        self._shown_at = time.monotonic()
+
+    async def __call__(self, done, total):
+        now = time.monotonic()
+        if done < total and now - self._shown_at < self.interval:
+            return
+        self._shown_at = now
+        try:
+            await self.message.edit_text(f"{self.title}: {done} из {total}")
+        except TelegramError as e:
+            # Прогресс — только подсказка: RetryAfter или сетевая ошибка не должны прерывать саму операцию
+            logger.warning(f"Не удалось обновить прогресс: {e}")
+
+# Фоновые задачи синхронизации канала: Application.stop() ждал бы их до конца, поэтому они отменяются при остановке
+channel_jobs = set()
+# Задачи идут по одной: иначе вторая запланировала бы публикацию товаров, которые первая ещё не выложила
+channel_job_lock = asyncio.Lock()
+
+async def run_channel_job(context: ContextTypes.DEFAULT_TYPE, status_message, title, products=(), previous=None, deleted=()):
+    """previous — товары до изменения каталога ({id: товар}), по ним определяются правки."""
+    async with channel_job_lock:
+        # Пока задача стояла в очереди, предыдущая могла выложить эти товары: берём их текущие версии из каталога
+        products = [product for product in (catalog.get(p["id"]) for p in products) if product is not None]
+        stats = await channel_sync.run(
+            context.bot, products, previous, deleted=deleted, progress=ProgressReporter(status_message, title)
+        )
+    await status_message.edit_text(
+        f"{title}: готово. Обновлено: {stats['edited']}, опубликовано: {stats['posted']}, "
+        f"удалено: {stats['deleted']}, без изменений: {stats['unchanged']}, ошибок: {stats['failed']}"
+    )
+
+async def start_channel_job(update: Update, context: ContextTypes.DEFAULT_TYPE, title, **job):
+    # Посты правятся в фоне: при лимите канала ~20 сообщений в минуту это может занять долго
+    status_message = await update.effective_message.reply_text(f"{title}: в очереди")
+    task = asyncio.get_running_loop().create_task(run_channel_job(context, status_message, title, **job))
+    channel_jobs.add(task)
+    task.add_done_callback(channel_job_done)
+
+def channel_job_done(task):
+    channel_jobs.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка синхронизации канала", exc_info=task.exception())
+
+async def cancel_channel_jobs():
+    # message_id сохраняются по мере публикации, так что следующая синхронизация продолжит с места остановки
+    for task in list(channel_jobs):
+        task.cancel()
+    await asyncio.gather(*channel_jobs, return_exceptions=True)
+
+async def bulk_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not check_permission(user_id, "all"):
+        await update.message.reply_text("Только админ может менять цены!")
+        return
+    change = parse_price_change(context.args[0]) if context.args else None
+    if change is None:
+        await update.message.reply_text(
+            "Использование: /price <изменение> [запрос]\n"
+            "Изменение: +10%, -15%, +100, -50 или =990. Без запроса меняются все товары."
+        )
+        return
+    query = " ".join(context.args[1:])
+    products = matching_products(query)
+    if not products:
+        await update.message.reply_text("Товары не найдены!")
+        return
+    # Новые цены считаются заранее: каталог меняется целиком или не меняется вовсе
+    changes = {}
+    for product in products:
+        price = change(float(product["price"]))
+        if price < 0:
+            await update.message.reply_text(f"Цена товара «{product['name']}» станет отрицательной, каталог не изменён.")
+            return
+        changes[product["id"]] = {"price": format_price(price)}
+    previous = {p["id"]: dict(p) for p in products}
+    updated = catalog.update_many(changes)
+    journal.record(context.application, user_id, "bulk_price", change=context.args[0], query=query, count=len(updated))
+    await start_channel_job(update, context, f"Цены изменены у {len(updated)} товаров", products=updated, previous=previous)
+
+async def bulk_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not check_permission(update.effective_user.id, "all"):
+        await update.message.reply_text("Только админ может удалять товары!")
+        return
+    query = " ".join(context.args or [])
+    if not search_tokens(query):
+        await update.message.reply_text("Использование: /delete_products <запрос> — удаляет все найденные товары.")
+        return
+    products = matching_products(query)
+    if not products:
+        await update.message.reply_text("Товары не найдены!")
+        return
+    context.user_data["bulk_delete"] = {"query": query, "ids": [p["id"] for p in products]}
+    names = "\n".join(p["name"] for p in products[:BULK_DELETE_PREVIEW])
+    if len(products) > BULK_DELETE_PREVIEW:
+        names += f"\n... и ещё {len(products) - BULK_DELETE_PREVIEW}"
+    keyboard = [[
+        InlineKeyboardButton("Удалить", callback_data=CB_BULK_DELETE),
+        InlineKeyboardButton("Отмена", callback_data=CB_BULK_CANCEL),
+    ]]
+    await update.message.reply_text(
+        f"Удалить {len(products)} товаров?\n{names}", reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def republish(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not check_permission(user_id, "all"):
+        await update.message.reply_text("Только админ может перепубликовать каталог!")
+        return
+    # Без sync_hash план считает каждый пост изменённым и правит его заново
+    products = catalog.update_many({p["id"]: {"sync_hash": None} for p in catalog.all()})
+    journal.record(context.application, user_id, "republish", count=len(products))
+    await start_channel_job(update, context, "Перепубликация", products=products)
+
+# Команда /stats
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f} ч"
+    return f"{seconds / 86400:.1f} дн"
+
+def format_stats(stats):
+    orders = stats["orders"]
+    lines = [
+        f"Заказов: {sum(orders.values())} (" + ", ".join(f"{ORDER_STATUSES[s].lower()}: {n}" for s, n in orders.items()) + ")",
+        f"Выручка: {stats['revenue']:.2f} руб.",
+        "Время до продажи: " + ", ".join(
+            f"p{int(q * 100)} ≤ {format_duration(histogram_percentile(stats['sold_seconds'], q))}" for q in (0.5, 0.9, 0.99)
+        ),
+    ]
+    if stats["days"]:
+        lines.append("\nПо дням:")
+        lines += [f"{d['day']}: заказов {d['orders']}, продано {d['sold']}, {d['revenue']:.2f} руб." for d in stats["days"]]
+    if stats["top_products"]:
+        lines.append("\nТоп товаров:")
+        lines += [f"{p['product_name']}: продано {p['sold']} из {p['orders']}, {p['revenue']:.2f} руб." for p in stats["top_products"]]
+    return "\n".join(lines)
+
+async def sales_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not check_permission(update.effective_user.id, "all"):
+        await update.message.reply_text("Только админ может смотреть статистику!")
+        return
+    await update.message.reply_text(format_stats(await order_store.stats()))
+
+# Команда /export
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not check_permission(user_id, "all"):
+        await update.message.reply_text("Только админ может выгружать данные!")
+        return
+    exporter.request(context.application, user_id)
+
+# Идемпотентность: повторная доставка вебхука и двойные нажатия
+UPDATE_DEDUP_TTL = 600
+UPDATE_DEDUP_SIZE = 50000
+ORDER_DEDUP_WINDOW = 10
+ORDER_DEDUP_SIZE = 10000
+
+class TTLCache:
+    """Ограниченное множество ключей с временем жизни; при переполнении вытесняются самые старые."""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires = OrderedDict()
+
+    def _expire(self, now):
+        # TTL у всех ключей одинаковый, поэтому порядок вставки совпадает с порядком истечения
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now:
+                break
+            del self._expires[key]
+
+    def add(self, key):
+        """Запоминает ключ; False, если он уже был и не истёк."""
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._expires:
+            return False
+        self._expires[key] = now + self.ttl
+        if len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+        return True
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+
+    def __len__(self):
+        return len(self._expires)
+
+seen_updates = TTLCache(UPDATE_DEDUP_TTL, UPDATE_DEDUP_SIZE)
+recent_orders = TTLCache(ORDER_DEDUP_WINDOW, ORDER_DEDUP_SIZE)
+
+# Маршрутизация callback_data
+CALLBACK_DATA_LIMIT = 64
+
+CB_ROLE_ORDER = "role_order"
+CB_ROLE_ADMIN = "role_admin"
+CB_ADD_PRODUCT = "add_product"
+CB_DELETE_PRODUCT = "delete_product"
+CB_ADD_EMPLOYEE = "add_employee"
+CB_REMOVE_EMPLOYEE = "remove_employee"
+CB_ORDER = "order_"
+CB_STATUS_PROCESSING = "status_processing_"
+CB_STATUS_SOLD = "status_sold_"
+CB_PUBLISH = "publish_"
+CB_DEL_PRODUCT = "del_product_"
+CB_BULK_DELETE = "bulk_delete"
+CB_BULK_CANCEL = "bulk_cancel"
+CB_DEL_NEXT = "del_next_"
+CB_DEL_PREV = "del_prev_"
+CB_DEL_EMPLOYEE = "del_employee_"
+# id товара должен поместиться в callback_data после самого длинного из префиксов кнопок товара
+PRODUCT_ID_MAX_BYTES = CALLBACK_DATA_LIMIT - max(
+    len(prefix.encode()) for prefix in (CB_ORDER, CB_PUBLISH, CB_DEL_PRODUCT, CB_DEL_NEXT, CB_DEL_PREV)
+)
+
+def pack_callback(prefix, payload):
+    """callback_data для действия с параметром; Telegram ограничивает её 64 байтами."""
+    data = f"{prefix}{payload}"
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}")
+    return data
+
+def parse_order_id(payload):
+    try:
+        return int(payload)
+    except (TypeError, ValueError):
+        return None
+
+async def reply_to_query(query, text):
+    # У сообщений, отправленных через инлайн-режим, нет query.message — правим само сообщение
+    if query.message is None:
+        await query.edit_message_text(text)
+    else:
+        await query.message.reply_text(text)
+
+# Выбор товара для удаления: страницы по курсору и поиск в инлайн-режиме
+DELETE_PAGE_SIZE = 8
+INLINE_RESULTS_LIMIT = 50
+
+def delete_picker(after=None, before=None):
+    """Текст и клавиатура страницы; курсор — id крайнего товара соседней страницы."""
+    products, start, has_prev, has_next = catalog.page(after, before, limit=DELETE_PAGE_SIZE)
+    if not products:
+        # Курсор указывает за конец каталога (товары удалили) — показываем первую страницу
+        products, start, has_prev, has_next = catalog.page(limit=DELETE_PAGE_SIZE)
+    keyboard = [[InlineKeyboardButton(p["name"], callback_data=pack_callback(CB_DEL_PRODUCT, p["id"]))] for p in products]
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=pack_callback(CB_DEL_PREV, products[0]["id"])))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперёд »", callback_data=pack_callback(CB_DEL_NEXT, products[-1]["id"])))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("Поиск", switch_inline_query_current_chat="")])
+    text = f"Выберите товар для удаления ({start + 1}–{start + len(products)} из {len(catalog)}):"
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Инлайн-поиск товаров для админов; offset — id последнего показанного товара."""
+    inline_query = update.inline_query
+    if not check_permission(inline_query.from_user.id, "all"):
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
+    products, next_cursor = catalog.search(inline_query.query, after=inline_query.offset or None, limit=INLINE_RESULTS_LIMIT)
+    results = [
+        InlineQueryResultArticle(
+            id=p["id"],
+            title=p["name"],
+            description=f"{p['price']} руб. {p['description']}",
+            input_message_content=InputTextMessageContent(
+                f"<b>{html.escape(p['name'])}</b>\nЦена: {html.escape(str(p['price']))} руб.", parse_mode="HTML"
+            ),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Удалить", callback_data=pack_callback(CB_DEL_PRODUCT, p["id"]))]]),
+        )
+        for p in products
+    ]
+    await inline_query.answer(results, cache_time=0, is_personal=True, next_offset=next_cursor or "")
+
+class CallbackRouter:
+    """Таблица обработчиков callback_data.
+
+    Точные действия ищутся в словаре. Префиксы действий с параметром оканчиваются на '_' —
+    проверяются только префиксы data до каждого '_' (не больше, чем частей в самом длинном
+    префиксе), поэтому стоимость не зависит от числа действий, а параметр берётся целиком,
+    даже если в нём есть '_'.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._max_parts = 0
+
+    def action(self, name):
+        def register(handler):
+            self._exact[name] = handler
+            return handler
+        return register
+
+    def prefix(self, prefix):
+        if not prefix.endswith("_"):
+            raise ValueError("Префикс действия должен оканчиваться на '_'")
+        def register(handler):
+            self._prefixes[prefix] = handler
+            self._max_parts = max(self._max_parts, prefix.count("_"))
+            return handler
+        return register
+
+    def resolve(self, data):
+        """Возвращает (обработчик, параметр) или (None, None)."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None
+        found = (None, None)
+        pos = -1
+        for _ in range(self._max_parts):
+            pos = data.find("_", pos + 1)
+            if pos < 0:
+                break
+            handler = self._prefixes.get(data[:pos + 1])
+            if handler is not None:
+                found = (handler, data[pos + 1:])
+        return found
+
+router = CallbackRouter()
+
 # Обработчик кнопок
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    handler, payload = router.resolve(query.data or "")
+    if handler is None:
+        return
+    with CALLBACK_SECONDS.labels(handler.__name__.removeprefix("on_")).time():
+        return await handler(update, context, payload)
+
+@router.action(CB_ROLE_ORDER)
+async def on_role_order(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
     user_id = query.from_user.id
-    data = query.data
+    if not check_permission(user_id, "orders"):
+        await query.message.reply_text("Нет доступа к заказам!")
+        return
+    await query.message.reply_text("Выберите заказ для обработки (в разработке).")
 
-    if data == "role_order":
-        if not check_permission(user_id, "orders"):
-            await query.message.reply_text("Нет доступа к заказам!")
-            return
-        await query.message.reply_text("Выберите заказ для обработки (в разработке).")
+@router.action(CB_ROLE_ADMIN)
+async def on_role_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if not check_permission(user_id, "all"):
+        await query.message.reply_text("Только админ может управлять магазином!")
+        return
+    keyboard = [
+        [InlineKeyboardButton("Добавить товар", callback_data=CB_ADD_PRODUCT)],
+        [InlineKeyboardButton("Удалить товар", callback_data=CB_DELETE_PRODUCT)],
+        [InlineKeyboardButton("Добавить сотрудника", callback_data=CB_ADD_EMPLOYEE)],
+        [InlineKeyboardButton("Удалить сотрудника", callback_data=CB_REMOVE_EMPLOYEE)]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.message.reply_text("Меню админа:", reply_markup=reply_markup)
 
-    elif data == "role_admin":
-        if not check_permission(user_id, "all"):
-            await query.message.reply_text("Только админ может управлять магазином!")
-            return
-        keyboard = [
-            [InlineKeyboardButton("Добавить товар", callback_data="add_product")],
-            [InlineKeyboardButton("Удалить товар", callback_data="delete_product")],
-            [InlineKeyboardButton("Добавить сотрудника", callback_data="add_employee")],
-            [InlineKeyboardButton("Удалить сотрудника", callback_data="remove_employee")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Меню админа:", reply_markup=reply_markup)
-
-    elif data == "add_product":
-        await query.message.reply_text("Отправьте фото товара (или напишите 'без фото'):")
-        return PHOTO
+@router.action(CB_ADD_PRODUCT)
+async def on_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    await query.message.reply_text("Отправьте фото товара (или напишите 'без фото'):")
+    return PHOTO
 
-    elif data == "delete_product":
-        products = load_products()
-        if not products:
-            await query.message.reply_text("Товаров нет!")
-            return ConversationHandler.END
-        keyboard = [[InlineKeyboardButton(p["name"], callback_data=f"del_product_{p['id']}")] for p in products]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Выберите товар для удаления:", reply_markup=reply_markup)
-        return DELETE_PRODUCT
-
-    elif data == "add_employee":
-        await query.message.reply_text("Введите Telegram ID или @username:")
-        return EMPLOYEE_ID
-
-    elif data == "remove_employee":
-        admins = load_admins()
-        if len(admins) <= 1:
-            await query.message.reply_text("Нельзя удалить последнего админа!")
-            return ConversationHandler.END
-        keyboard = [[InlineKeyboardButton(str(a["user_id"]), callback_data=f"del_employee_{a['user_id']}")] for a in admins]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Выберите сотрудника для удаления:", reply_markup=reply_markup)
-        return DELETE_EMPLOYEE
-
-    elif data.startswith("order_"):
-        product_id = data.split("_")[1]
-        products = load_products()
-        product = next((p for p in products if p["id"] == product_id), None)
-        if not product:
-            await query.message.reply_text("Товар не найден!")
-            return
-        text = f"<b>Название:</b> {product['name']}\n<b>Цена:</b> {product['price']} руб.\n<b>Описание:</b> {product['description']}"
-        if product.get("photo_id"):
-            await context.bot.send_photo(chat_id=user_id, photo=product["photo_id"], caption=text, parse_mode="HTML")
-        else:
-            await context.bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
-        
-        # Генерация уникального ID заказа
-        order_id = len(load_products()) + 1
-        username = query.from_user.username or "неизвестен"
-        order_text = f"Заказ #{order_id} | Товар: {product['name']} | Клиент: @{username} | Статус: Новый"
-        order_message = await context.bot.send_message(chat_id=ORDERS_CHANNEL, text=order_text)
-        
-        # Сохранение информации о заказе
-        if "orders" not in context.bot_data:
-            context.bot_data["orders"] = {}
-        context.bot_data["orders"][order_id] = {
-            "message_id": order_message.message_id,
-            "buyer_id": query.from_user.id,
-            "product_name": product['name'],
-            "product_price": product['price'],
-            "username": username
-        }
-        
-        admins = load_admins()
-        for admin in admins:
-            notify_text = f"Новый заказ #{order_id}: Товар: {product['name']}, Цена: {product['price']} руб., Клиент: @{username}"
-            keyboard = [
-                [InlineKeyboardButton("Взять в обработку", callback_data=f"status_processing_{order_id}")],
-                [InlineKeyboardButton("Отметить как продан", callback_data=f"status_sold_{order_id}")],
-                [InlineKeyboardButton("Связаться с клиентом", url=f"tg://user?id={query.from_user.id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(
-                chat_id=admin["user_id"],
-                text=notify_text,
-                reply_markup=reply_markup,
-                parse_mode="HTML"
-            )
-        await query.message.reply_text("Заказ оформлен! С вами свяжутся.")
+@router.action(CB_DELETE_PRODUCT)
+async def on_delete_product(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    if not check_permission(query.from_user.id, "all"):
+        await query.message.reply_text("Только админ может удалять товары!")
+        return ConversationHandler.END
+    if not len(catalog):
+        await query.message.reply_text("Товаров нет!")
+        return ConversationHandler.END
+    text, reply_markup = delete_picker()
+    await query.message.reply_text(text, reply_markup=reply_markup)
+    return DELETE_PRODUCT
 
-    elif data.startswith("status_processing_"):
-        order_id = int(data.split("_")[2])
-        if not check_permission(user_id, "orders") and not check_permission(user_id, "all"):
-            await query.message.reply_text("Нет прав для изменения статуса!")
-            return
-        
-        if "orders" in context.bot_data and order_id in context.bot_data["orders"]:
-            order_info = context.bot_data["orders"][order_id]
-            message_id = order_info["message_id"]
-            buyer_id = order_info["buyer_id"]
-            product_name = order_info["product_name"]
-            username = order_info["username"]
-            
-            order_text = f"Заказ #{order_id} | Товар: {product_name} | Клиент: @{username} | Статус: В обработке"
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=ORDERS_CHANNEL,
-                    message_id=message_id,
-                    text=order_text
-                )
-            except Exception as e:
-                print(f"Ошибка обновления сообщения: {e}")
-            
-            # Уведомление клиента
-            try:
-                await context.bot.send_message(
-                    chat_id=buyer_id,
-                    text=f"Ваш заказ #{order_id} в обработке!"
-                )
-            except Exception as e:
-                print(f"Ошибка отправки уведомления клиенту: {e}")
-            
-            await query.message.reply_text(f"Заказ #{order_id} взят в обработку!")
-        else:
-            await query.message.reply_text("Заказ не найден!")
+@router.action(CB_BULK_DELETE)
+async def on_bulk_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if not check_permission(user_id, "all"):
+        await query.message.reply_text("Только админ может удалять товары!")
+        return
+    pending = context.user_data.pop("bulk_delete", None)
+    if pending is None:
+        await query.edit_message_text("Нечего удалять: запрос устарел.")
+        return
+    removed = catalog.remove_many(pending["ids"])
+    journal.record(context.application, user_id, "bulk_delete", query=pending["query"], count=len(removed))
+    await query.edit_message_text(f"Удалено товаров: {len(removed)}")
+    deleted = [p["message_id"] for p in removed if p.get("message_id")]
+    if deleted:
+        await start_channel_job(update, context, "Удаление постов", deleted=deleted)
 
-    elif data.startswith("status_sold_"):
-        order_id = int(data.split("_")[2])
-        if not check_permission(user_id, "orders") and not check_permission(user_id, "all"):
-            await query.message.reply_text("Нет прав для изменения статуса!")
-            return
-        
-        if "orders" in context.bot_data and order_id in context.bot_data["orders"]:
-            order_info = context.bot_data["orders"][order_id]
-            message_id = order_info["message_id"]
-            buyer_id = order_info["buyer_id"]
-            product_name = order_info["product_name"]
-            username = order_info["username"]
-            
-            order_text = f"Заказ #{order_id} | Товар: {product_name} | Клиент: @{username} | Статус: Продан"
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=ORDERS_CHANNEL,
-                    message_id=message_id,
-                    text=order_text
-                )
-            except Exception as e:
-                print(f"Ошибка обновления сообщения: {e}")
-            
-            # Уведомление клиента
-            try:
-                await context.bot.send_message(
-                    chat_id=buyer_id,
-                    text=f"Ваш заказ #{order_id} продан! Спасибо за покупку!"
-                )
-            except Exception as e:
-                print(f"Ошибка отправки уведомления клиенту: {e}")
-            
-            await query.message.reply_text(f"Заказ #{order_id} отмечен как продан!")
-        else:
-            await query.message.reply_text("Заказ не найден!")
+@router.action(CB_BULK_CANCEL)
+async def on_bulk_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    context.user_data.pop("bulk_delete", None)
+    await update.callback_query.edit_message_text("Удаление отменено.")
 
-    elif data.startswith("publish_"):
-        product_id = data.split("_")[1]
-        product = context.user_data.get("product")
-        if not product or product["id"] != product_id:
-            await query.message.reply_text("Ошибка, товар не найден!")
-            return
-        text = f"<b>Название:</b> {product['name']}\n<b>Цена:</b> {product['price']} руб.\n<b>Описание:</b> {product['description']}"
-        keyboard = [[InlineKeyboardButton("Заказать", callback_data=f"order_{product_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+@router.prefix(CB_DEL_NEXT)
+async def on_del_next(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    return await show_delete_page(update.callback_query, after=payload)
+
+@router.prefix(CB_DEL_PREV)
+async def on_del_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    return await show_delete_page(update.callback_query, before=payload)
+
+async def show_delete_page(query, after=None, before=None):
+    if not check_permission(query.from_user.id, "all"):
+        return ConversationHandler.END
+    if not len(catalog):
+        await query.edit_message_text("Товаров нет!")
+        return ConversationHandler.END
+    text, reply_markup = delete_picker(after, before)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return DELETE_PRODUCT
+
+@router.action(CB_ADD_EMPLOYEE)
+async def on_add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    await query.message.reply_text("Введите Telegram ID или @username:")
+    return EMPLOYEE_ID
+
+@router.action(CB_REMOVE_EMPLOYEE)
+async def on_remove_employee(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    admins = load_admins()
+    if len(admins) <= 1:
+        await query.message.reply_text("Нельзя удалить последнего админа!")
+        return ConversationHandler.END
+    keyboard = [[InlineKeyboardButton(str(a["user_id"]), callback_data=pack_callback(CB_DEL_EMPLOYEE, a["user_id"]))] for a in admins]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.message.reply_text("Выберите сотрудника для удаления:", reply_markup=reply_markup)
+    return DELETE_EMPLOYEE
+
+@router.prefix(CB_ORDER)
+async def on_order(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    # Повторное нажатие на тот же товар в течение ORDER_DEDUP_WINDOW не создаёт второй заказ
+    key = (query.from_user.id, payload)
+    if not recent_orders.add(key):
+        DUPLICATES_SUPPRESSED.labels("order").inc()
+        return
+    try:
+        await place_order(query, context, payload)
+    except Exception:
+        recent_orders.discard(key)
+        raise
+
+async def place_order(query, context: ContextTypes.DEFAULT_TYPE, product_id):
+    user_id = query.from_user.id
+    product = catalog.get(product_id)
+    if not product:
+        await query.message.reply_text("Товар не найден!")
+        return
+    text, _ = render_product_card(product)
+    # Карточка клиенту идёт через общий лимитер, как и остальные отправки
+    if product.get("photo_id"):
+        await rate_limiter.call(user_id, lambda: context.bot.send_photo(
+            chat_id=user_id, photo=product["photo_id"], caption=text, parse_mode="HTML"
+        ))
+    else:
+        await rate_limiter.call(user_id, lambda: context.bot.send_message(chat_id=user_id, text=text, parse_mode="HTML"))
+
+    # Генерация уникального ID заказа
+    order_id = await order_ids.next_id()
+    username = query.from_user.username or "неизвестен"
+
+    # Заказ сохраняется вместе с постом для канала заказов: лимит канала (~20 постов в минуту)
+    # не задерживает ответ клиенту, пост уходит через outbox и message_id записывается после отправки
+    order = {"id": order_id, "product_name": product["name"], "username": username, "status": "new", "message_id": None}
+    await order_store.create(
+        order_id,
+        messages=[order_channel_message(order)],
+        buyer_id=query.from_user.id,
+        product_id=product["id"],
+        product_name=product["name"],
+        product_price=product["price"],
+        username=username,
+    )
+    outbox.wake()
+
+    # Уведомления сотрудникам уходят в фоне, клиент получает ответ сразу
+    notify_text = (
+        f"Новый заказ #{order_id}: Товар: {html.escape(product['name'])}, "
+        f"Цена: {html.escape(str(product['price']))} руб., Клиент: @{html.escape(username)}"
+    )
+    keyboard = [
+        [InlineKeyboardButton("Взять в обработку", callback_data=pack_callback(CB_STATUS_PROCESSING, order_id))],
+        [InlineKeyboardButton("Отметить как продан", callback_data=pack_callback(CB_STATUS_SOLD, order_id))],
+        [InlineKeyboardButton("Связаться с клиентом", url=f"tg://user?id={query.from_user.id}")]
+    ]
+    notifications.fan_out(
+        context.application,
+        notification_chat_ids(),
+        notify_text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+    ORDERS_TOTAL.inc()
+    await query.message.reply_text("Заказ оформлен! С вами свяжутся.")
+
+@router.prefix(CB_STATUS_PROCESSING)
+async def on_status_processing(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    order_id = parse_order_id(payload)
+    if order_id is None:
+        return
+    if not check_permission(user_id, "orders"):
+        await query.message.reply_text("Нет прав для изменения статуса!")
+        return
+    await change_order_status(
+        query, context, order_id, "processing",
+        buyer_text=f"Ваш заказ #{order_id} в обработке!",
+        reply_text=f"Заказ #{order_id} взят в обработку!",
+    )
+
+@router.prefix(CB_STATUS_SOLD)
+async def on_status_sold(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    order_id = parse_order_id(payload)
+    if order_id is None:
+        return
+    if not check_permission(user_id, "orders"):
+        await query.message.reply_text("Нет прав для изменения статуса!")
+        return
+    await change_order_status(
+        query, context, order_id, "sold",
+        buyer_text=f"Ваш заказ #{order_id} продан! Спасибо за покупку!",
+        reply_text=f"Заказ #{order_id} отмечен как продан!",
+    )
+
+@router.prefix(CB_PUBLISH)
+async def on_publish(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    product_id = payload
+    product = context.user_data.get("product")
+    if not product or product["id"] != product_id:
+        await query.message.reply_text("Ошибка, товар не найден!")
+        return
+    if catalog.get(product["id"]) is not None:
+        # id успел занять другой товар, пока готовилось превью — берём следующий свободный
+        product["id"] = catalog.next_id()
+        product["name"] = "Товар #" + product["id"]
+    # Товар занимает id в каталоге до отправки поста, чтобы параллельная публикация не получила тот же
+    catalog.add(product)
+    text, reply_markup = render_product_card(product)
+    # Канал делит лимит с фоновой синхронизацией, поэтому пост идёт через общий лимитер с повторами
+    try:
         if product["photo_id"]:
-            message = await context.bot.send_photo(
+            message = await rate_limiter.call(PRODUCTS_CHANNEL, lambda: context.bot.send_photo(
                 chat_id=PRODUCTS_CHANNEL,
                 photo=product["photo_id"],
                 caption=text,
                 reply_markup=reply_markup,
                 parse_mode="HTML"
-            )
+            ))
         else:
-            message = await context.bot.send_message(
+            message = await rate_limiter.call(PRODUCTS_CHANNEL, lambda: context.bot.send_message(
                 chat_id=PRODUCTS_CHANNEL,
                 text=text,
                 reply_markup=reply_markup,
                 parse_mode="HTML"
-            )
-        product["message_id"] = message.message_id
-        products = load_products()
-        products.append(product)
-        save_products(products)
-        await send_json_files(query, context, user_id)
-        await query.message.reply_text("Товар опубликован в @ShopProductsgg!")
-        context.user_data.clear()
-
-    elif data.startswith("del_product_"):
-        product_id = data.split("_")[2]
-        products = load_products()
-        product = next((p for p in products if p["id"] == product_id), None)
-        if not product:
-            await query.message.reply_text("Товар не найден!")
-            return ConversationHandler.END
-        try:
-            if product.get("message_id"):
-                await context.bot.delete_message(chat_id=PRODUCTS_CHANNEL, message_id=product["message_id"])
-        except Exception as e:
-            print(f"Ошибка удаления сообщения: {e}")
-        products = [p for p in products if p["id"] != product_id]
-        save_products(products)
-        await send_json_files(query, context, user_id)
-        await query.message.reply_text(f"Товар {product['name']} удалён!")
+            ))
+    except Exception:
+        catalog.remove(product["id"])
+        raise
+    catalog.update(product["id"], message_id=message.message_id, sync_hash=product_fingerprint(product))
+    journal.record(context.application, user_id, "product_add", id=product["id"], name=product["name"], price=product["price"])
+    await query.message.reply_text("Товар опубликован в @ShopProductsgg!")
+    context.user_data.clear()
+
+@router.prefix(CB_DEL_PRODUCT)
+async def on_del_product(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if not check_permission(user_id, "all"):
+        await reply_to_query(query, "Только админ может удалять товары!")
         return ConversationHandler.END
+    product_id = payload
+    product = catalog.get(product_id)
+    if not product:
+        await reply_to_query(query, "Товар не найден!")
+        return ConversationHandler.END
+    try:
+        if product.get("message_id"):
+            await rate_limiter.call(PRODUCTS_CHANNEL, lambda: context.bot.delete_message(
+                chat_id=PRODUCTS_CHANNEL, message_id=product["message_id"]
+            ))
+    except Exception as e:
+        logger.error(f"Ошибка удаления сообщения: {e}")
+    catalog.remove(product_id)
+    journal.record(context.application, user_id, "product_delete", id=product_id, name=product["name"])
+    await reply_to_query(query, f"Товар {product['name']} удалён!")
+    return ConversationHandler.END
 
-    elif data.startswith("del_employee_"):
-        employee_id = data.split("_")[2]
-        admins = load_admins()
-        if len(admins) <= 1:
-            await query.message.reply_text("Нельзя удалить последнего админа!")
-            return ConversationHandler.END
-        # Конвертируем в строку для корректного сравнения
-        try:
-            employee_id_int = int(employee_id)
-            admins = [a for a in admins if a["user_id"] != employee_id_int and str(a["user_id"]) != employee_id]
-        except ValueError:
-            admins = [a for a in admins if str(a["user_id"]) != employee_id]
-        save_admins(admins)
-        await send_json_files(query, context, user_id)
-        await query.message.reply_text(f"Сотрудник {employee_id} удалён!")
+@router.prefix(CB_DEL_EMPLOYEE)
+async def on_del_employee(update: Update, context: ContextTypes.DEFAULT_TYPE, payload=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    employee_id = payload
+    admins = load_admins()
+    if len(admins) <= 1:
+        await query.message.reply_text("Нельзя удалить последнего админа!")
         return ConversationHandler.END
+    # Конвертируем в строку для корректного сравнения
+    try:
+        employee_id_int = int(employee_id)
+        admins = [a for a in admins if a["user_id"] != employee_id_int and str(a["user_id"]) != employee_id]
+    except ValueError:
+        admins = [a for a in admins if str(a["user_id"]) != employee_id]
+    save_admins(admins)
+    journal.record(context.application, user_id, "admin_remove", user_id=employee_id)
+    await query.message.reply_text(f"Сотрудник {employee_id} удалён!")
+    return ConversationHandler.END
 
 # Обработчик добавления товара
 async def add_product_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -460,15 +3412,14 @@ async def add_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("Введите корректную цену (число):")
         return PRICE
-    products = load_products()
-    product_id = f"{len(products) + 1:03d}"
+    product_id = catalog.next_id()
     name = "Товар #" + product_id
     description = context.user_data["description"]
     photo_id = context.user_data.get("photo_id")
-    text = f"<b>Название:</b> {name}\n<b>Цена:</b> {price} руб.\n<b>Описание:</b> {description}"
+    text = product_caption(name, price, description)
     keyboard = [
-        [InlineKeyboardButton("Опубликовать", callback_data=f"publish_{product_id}")],
-        [InlineKeyboardButton("Редактировать", callback_data="add_product")]
+        [InlineKeyboardButton("Опубликовать", callback_data=pack_callback(CB_PUBLISH, product_id))],
+        [InlineKeyboardButton("Редактировать", callback_data=CB_ADD_PRODUCT)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if photo_id:
@@ -503,7 +3454,8 @@ async def add_employee_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     text = update.message.text
     if text.startswith("@"):
-        context.user_data["employee_id"] = text
+        # Если сотрудник уже писал боту, id известен; иначе он подставится при первом сообщении
+        context.user_data["employee_id"] = usernames.get(text) or text
     else:
         try:
             context.user_data["employee_id"] = int(text)
@@ -528,25 +3480,56 @@ async def add_employee_role(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверяем, не добавлен ли уже такой сотрудник
     for admin in admins:
-        if admin["user_id"] == employee_id or str(admin["user_id"]) == str(employee_id):
+        if admin_key(admin["user_id"]) == admin_key(employee_id):
             await query.message.reply_text("Этот сотрудник уже добавлен!")
             return ConversationHandler.END
     
     admins.append({"user_id": employee_id, "role": role, "permissions": permissions})
     save_admins(admins)
-    await send_json_files(query, context, query.from_user.id)
-    await query.message.reply_text(f"Добавлен сотрудник {employee_id} с ролью {role}!")
+    journal.record(context.application, query.from_user.id, "admin_add", user_id=employee_id, role=role)
+    text = f"Добавлен сотрудник {employee_id} с ролью {role}!"
+    if isinstance(admin_key(employee_id), str):
+        text += " Права заработают, когда сотрудник напишет боту."
+    await query.message.reply_text(text)
     return ConversationHandler.END
 
-def main():
-    keep_alive()
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    HANDLER_ERRORS.inc()
+    logger.error("Ошибка обработки обновления", exc_info=context.error)
 
-    """Запуск бота с вебхуком"""
-    application = Application.builder().token(BOT_TOKEN).build()
+async def on_shutdown(application: Application):
+    await catalog.flush()
+    await admin_registry.flush()
+    await usernames.flush()
+    snapshot.save(catalog, admin_registry)
+    await order_store.close()
+    await state.close()
+
+def build_application():
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .updater(None)
+        .request(RoutingRequest())
+        # getUpdates не используется (только вебхук), но PTB иначе создаёт для него свой клиент
+        .get_updates_request(PooledRequest("updates", 1, http_version=REQUEST_HTTP_VERSION))
+        .concurrent_updates(PerUserUpdateProcessor())
+    )
+    if state.shared:
+        builder = builder.persistence(SQLitePersistence(state))
+    application = builder.build()
 
     # Настройка хендлеров
+    application.add_handler(TypeHandler(Update, learn_username), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("upload_json", upload_json))
+    application.add_handler(CommandHandler("export", export))
+    application.add_handler(CommandHandler("stats", sales_stats))
+    application.add_handler(CommandHandler("price", bulk_price))
+    application.add_handler(CommandHandler("delete_products", bulk_delete))
+    application.add_handler(CommandHandler("republish", republish))
     
     # ConversationHandler для добавления товара
     product_conv = ConversationHandler(
@@ -557,6 +3540,8 @@ def main():
             PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_price)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="product_conv",
+        persistent=state.shared,
     )
     application.add_handler(product_conv)
 
@@ -568,6 +3553,8 @@ def main():
             EMPLOYEE_ROLE: [CallbackQueryHandler(add_employee_role, pattern="^role_(admin|seller)_employee$")],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="employee_conv",
+        persistent=state.shared,
     )
     application.add_handler(employee_conv)
 
@@ -578,20 +3565,149 @@ def main():
             CallbackQueryHandler(button, pattern="^remove_employee$")
         ],
         states={
-            DELETE_PRODUCT: [CallbackQueryHandler(button, pattern="^del_product_")],
+            DELETE_PRODUCT: [CallbackQueryHandler(button, pattern="^(del_product|del_next|del_prev)_")],
             DELETE_EMPLOYEE: [CallbackQueryHandler(button, pattern="^del_employee_")]
         },
         fallbacks=[CommandHandler("start", start)],
+        name="delete_conv",
+        persistent=state.shared,
     )
     application.add_handler(delete_conv)
 
     # Остальные CallbackQueryHandler
     application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(InlineQueryHandler(inline_search))
+    application.add_error_handler(on_error)
+    return application
+
+# Веб-приложение: health-check и вебхук Telegram в одном event loop
+def create_web_app(application: Application, affinity=None):
+    async def health(request: Request):
+        return PlainTextResponse("Bot is running!")
+
+    async def metrics(request: Request):
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+    async def webhook(request: Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        forwarded = request.headers.get("X-Worker-Forwarded")
+        if forwarded and request.headers.get("X-Worker-Secret") != WORKER_SECRET:
+            return Response(status_code=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        # Telegram повторяет обновление, если не дождался ответа; повтор подтверждаем и не обрабатываем
+        if isinstance(data, dict) and "update_id" in data and not seen_updates.add(data["update_id"]):
+            DUPLICATES_SUPPRESSED.labels("update").inc()
+            return Response()
+        update = Update.de_json(data, application.bot)
+        if affinity is not None and not forwarded and await affinity.forward(update, data):
+            return Response()
+        # Обновление ставится в очередь, ответ Telegram уходит сразу
+        await application.update_queue.put(update)
+        return Response()
+
+    return Starlette(routes=[
+        Route("/", health, methods=["GET", "HEAD"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route(WEBHOOK_PATH, webhook, methods=["POST"]),
+    ])
+
+# Холодный старт: фазы запуска и регистрация вебхука
+class StartupTimer:
+    def __init__(self, started):
+        self.started = started
+        self._last = started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        STARTUP_SECONDS.labels(phase).set(now - self._last)
+        self._last = now
+
+    def report(self):
+        total = self._last - self.started
+        STARTUP_SECONDS.labels("total").set(total)
+        logger.info(
+            f"Запуск за {total * 1000:.0f} мс: "
+            + ", ".join(f"{phase} {seconds * 1000:.0f}" for phase, seconds in self.phases)
+        )
+
+async def ensure_webhook(bot, url):
+    """Регистрирует вебхук, если Telegram знает другой адрес или сменился секрет."""
+    fingerprint = hashlib.sha256(f"{url}\n{WEBHOOK_SECRET or ''}".encode()).hexdigest()
+    info = await bot.get_webhook_info()
+    if info.url == url and snapshot.webhook == fingerprint:
+        return
+    await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET)
+    snapshot.webhook = fingerprint
+
+async def finish_startup(server, application, timer, webhook_url, save_snapshot):
+    # Сервер уже принимает запросы; вебхук сверяется после этого, не задерживая первые обновления
+    while not server.started:
+        await asyncio.sleep(0.005)
+    timer.mark("serve")
+    timer.report()
+    try:
+        await ensure_webhook(application.bot, webhook_url)
+    except Exception as e:
+        logger.error(f"Ошибка регистрации вебхука: {e}")
+    if save_snapshot:
+        snapshot.save(catalog, admin_registry)
+
+async def run_bot():
+    """Запуск бота с вебхуком"""
+    timer = StartupTimer(BOOT_STARTED)
+    timer.mark("imports")
+    restored = snapshot.restore(catalog, admin_registry)
+    if not restored:
+        catalog.load()
+        admin_registry.load()
+    usernames.load()
+    timer.mark("snapshot" if restored else "state")
+    application = build_application()
 
-    # Настройка вебхука
     port = int(os.getenv("PORT", 10000))
-    webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/webhook" if os.getenv("RENDER_EXTERNAL_HOSTNAME") else "https://your-render-url.onrender.com/webhook"
-    application.run_webhook(listen="0.0.0.0", port=port, url_path="/webhook", webhook_url=webhook_url)
+    webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}{WEBHOOK_PATH}" if os.getenv("RENDER_EXTERNAL_HOSTNAME") else f"https://your-render-url.onrender.com{WEBHOOK_PATH}"
+    affinity = None
+    if WORKER_URL:
+        if not state.shared or not WORKER_SECRET:
+            raise RuntimeError("WORKER_URL требует STATE_BACKEND=sqlite и WORKER_SECRET")
+        affinity = WorkerAffinity(state, WORKER_ID, WORKER_URL)
+    server = uvicorn.Server(uvicorn.Config(create_web_app(application, affinity), host="0.0.0.0", port=port, use_colors=False))
+    timer.mark("build")
+
+    try:
+        # getMe из initialize и прогрев пулов идут параллельно; async with повторно не инициализирует
+        await asyncio.gather(application.initialize(), application.bot.request.prewarm(f"{application.bot.base_url}/getMe"))
+        timer.mark("initialize")
+        async with application:
+            if affinity is not None:
+                await affinity.start()
+            await application.start()
+            outbox.start(application.bot)
+            timer.mark("start")
+            startup = asyncio.get_running_loop().create_task(
+                finish_startup(server, application, timer, webhook_url, save_snapshot=not restored)
+            )
+            try:
+                await server.serve()
+            finally:
+                startup.cancel()
+                await cancel_channel_jobs()
+                await outbox.stop()
+                if affinity is not None:
+                    await affinity.stop()
+                await application.stop()
+    finally:
+        await on_shutdown(application)
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    asyncio.run(run_bot())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,55 @@
+import io
+import json
+
+import pytest
+
+import bot
+
+VALID = [
+    "[]",
+    " [ ] \n",
+    "[1.5]",
+    "[1e5]",
+    "[-1.25e-3]",
+    "[12345, 678]",
+    '[{"id": "a", "price": 10.25}, {"id": "b", "tags": [1, 2.5e3]}]',
+    '  [ "x" , true , null , -0 ]  ',
+]
+INVALID = ["[1,]", "[,]", "[1] x", "[1]]", "[] ,", "[1 2]", "[", "[1,", "[1.]", "[tru]"]
+
+
+def parse(text, chunk_size):
+    return list(bot.iter_json_array(io.StringIO(text), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 64])
+@pytest.mark.parametrize("text", VALID)
+def test_iter_json_array_matches_json_loads(text, chunk_size):
+    assert parse(text, chunk_size) == json.loads(text)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 64])
+@pytest.mark.parametrize("text", INVALID)
+def test_iter_json_array_rejects_what_json_loads_rejects(text, chunk_size):
+    with pytest.raises(ValueError):
+        json.loads(text)
+    with pytest.raises(ValueError):
+        parse(text, chunk_size)
+
+
+def test_iter_json_array_requires_array():
+    with pytest.raises(ValueError):
+        parse("{}", 64)
+
+
+def test_ndjson_reports_malformed_line_and_keeps_the_rest(tmp_path):
+    path = tmp_path / "products.ndjson"
+    path.write_text(
+        '{"id": "a", "name": "A", "price": 1, "description": ""}\n'
+        '{"id": "b", "name": \n'
+        '{"id": "c", "name": "C", "price": 2, "description": ""}\n'
+    )
+    products, errors, error_count = bot.import_products(str(path), ndjson=True)
+
+    assert [p["id"] for p in products] == ["a", "c"]
+    assert error_count == 1 and errors[0].startswith("#2: некорректный JSON")
@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import pytest
+
+import bot
+
+
+def product(product_id, **fields):
+    return {"id": product_id, "name": product_id.upper(), "price": 100, "description": "", **fields}
+
+
+@pytest.fixture
+def make_catalog(tmp_path):
+    backends = []
+
+    def make():
+        backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+        backends.append(backend)
+        # Версию сверяем только при записи, чтобы процессы не видели изменений друг друга заранее
+        catalog = bot.ProductCatalog(backend, recheck_interval=3600)
+        catalog.load()
+        return catalog
+
+    yield make
+    for backend in backends:
+        backend._call(backend._close)
+        backend._executor.shutdown(wait=True)
+
+
+def ids(catalog):
+    return sorted(p["id"] for p in catalog.all())
+
+
+def test_two_processes_keep_each_others_products(make_catalog):
+    first, second = make_catalog(), make_catalog()
+    first.add(product("a"))
+    second.add(product("b"))
+
+    assert ids(second) == ["a", "b"]
+    assert ids(make_catalog()) == ["a", "b"]
+
+
+def test_conflicting_write_keeps_remote_fields_and_removals(make_catalog):
+    first, second = make_catalog(), make_catalog()
+    first.add(product("a"))
+    first.add(product("b"))
+    second.load()
+
+    first.update("a", message_id=10)
+    second.update("b", price=150)
+    first.remove("b")
+    second.add(product("c"))
+
+    fresh = make_catalog()
+    assert ids(fresh) == ["a", "c"]
+    assert fresh.get("a")["message_id"] == 10
+
+
+def test_background_flush_merges_with_other_process(make_catalog):
+    first, second = make_catalog(), make_catalog()
+
+    async def scenario():
+        first.add(product("a"))
+        second.add(product("b"))
+        await asyncio.gather(first.flush(), second.flush())
+
+    asyncio.run(scenario())
+    assert ids(make_catalog()) == ["a", "b"]
+
+
+def test_recheck_reloads_in_background(make_catalog):
+    first, second = make_catalog(), make_catalog()
+    second.recheck_interval = 0
+
+    async def scenario():
+        first.add(product("a"))
+        await first.flush()
+        # Читатель получает кэш сразу, а свежая версия подтягивается фоновой задачей
+        assert second.all() == []
+        await second._recheck_task
+        return ids(second)
+
+    assert asyncio.run(scenario()) == ["a"]
+
+
+def test_admin_save_is_written_behind(tmp_path):
+    backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+    registry = bot.AdminRegistry(backend)
+    registry.load()
+    admins = [{"user_id": 1, "role": "admin", "permissions": ["all"]}]
+
+    async def scenario():
+        registry.save(admins)
+        assert registry.has_permission(1, "all")
+        await registry.flush()
+        await backend.close()
+
+    asyncio.run(scenario())
+    reader = bot.AdminRegistry(bot.SQLiteStateBackend(str(tmp_path / "state.db")))
+    assert reader.all() == admins
+
+
+def test_load_skips_invalid_records_and_keeps_long_ids(tmp_path):
+    backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+    long_id = "sku-" + "x" * 60
+    backend.write("products", json.dumps([product("a"), product(long_id), {"id": "broken"}]))
+    catalog = bot.ProductCatalog(backend)
+    catalog.load()
+
+    assert ids(catalog) == ["a", long_id]
+    assert bot.validate_new_product(product(long_id)) is not None
+
+
+def test_stale_admin_save_does_not_restore_removed_employee(tmp_path):
+    path = str(tmp_path / "state.db")
+    boss = {"user_id": 1, "role": "admin", "permissions": ["all"]}
+    fired = {"user_id": 2, "role": "manager", "permissions": ["orders"]}
+    pending = {"user_id": "@newbie", "role": "manager", "permissions": ["orders"]}
+    first = bot.AdminRegistry(bot.SQLiteStateBackend(path), recheck_interval=3600)
+    first.load()
+    first.save([boss, fired, pending])
+    second = bot.AdminRegistry(bot.SQLiteStateBackend(path), recheck_interval=3600)
+    second.load()
+
+    second.save([boss, pending])
+    # Первый процесс ещё не видел удаления и дописывает id по username к своему старому списку
+    first.save([boss, fired, dict(pending, user_id=3)])
+
+    fresh = bot.AdminRegistry(bot.SQLiteStateBackend(path))
+    assert [bot.admin_key(a["user_id"]) for a in fresh.all()] == [1, 3]
+    assert not first.has_permission(2, "orders")
+
+
+def test_new_product_id_is_not_reused_after_deletion(make_catalog):
+    catalog = make_catalog()
+    for product_id in ("001", "002", "003"):
+        catalog.add(product(product_id))
+    catalog.remove("001")
+
+    assert catalog.next_id() == "004"
+    with pytest.raises(ValueError):
+        catalog.add(product("003", name="Другой"))
+    assert catalog.get("003")["name"] == "003"
+
+
+def test_usernames_learned_by_two_processes_are_merged(tmp_path):
+    path = str(tmp_path / "state.db")
+    first = bot.UsernameResolver(bot.SQLiteStateBackend(path))
+    second = bot.UsernameResolver(bot.SQLiteStateBackend(path))
+    first.load()
+    second.load()
+
+    async def scenario():
+        first.learn("alice", 1)
+        second.learn("bob", 2)
+        await first.flush()
+        await second.flush()
+
+    asyncio.run(scenario())
+    fresh = bot.UsernameResolver(bot.SQLiteStateBackend(path))
+    assert (fresh.get("@alice"), fresh.get("@bob")) == (1, 2)
+    assert second.get("alice") == 1